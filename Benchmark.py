@@ -0,0 +1,298 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import FeatureExtraction
+import Instrumentation
+import SyntheticDataset
+import audioBasicIO
+
+
+class Benchmark:
+    '''
+        Performance benchmark of the feature extraction on a synthetic dataset (see SyntheticDataset), to catch
+        performance regressions without the licensed Mivia dataset.
+
+        Each stage of the extraction of a job is timed on its own (CPU and wall time), on every job of the dataset:
+
+            readAudioFile        reading of the wav file (the samples are loaded in memory, as by the reader thread)
+            segmentation         parsing of the xml file and labeling of the segments
+            stFeatureExtraction  short-term features of the segments
+            aggregation          median/MAD (see FeatureExtraction.aggregation) of the short-term features
+            metadata             rows of the segments (features and metadata)
+            writeToCSV           writing of the rows in the .csv output
+
+        followed by the whole FeatureExtraction.processDataset run (pipeline). The stages are run self.repeat times,
+        the fastest run of each stage is reported. The throughput is in audio seconds per CPU second, the peak RSS
+        (the resident memory of the benchmark process) in MB.
+        The results can be saved as a baseline (json file) and compared with it: a stage more than self.tolerance
+        slower than in the baseline is reported as a regression. The baselines are comparable only on the same machine.
+
+        float32Error measures the error of the float32 computation on the same dataset (see
+        audioFeatureExtraction.stFeatureExtraction for the error budget it checks).
+    '''
+
+    stageNames = ['readAudioFile', 'segmentation', 'stFeatureExtraction', 'aggregation', 'metadata', 'writeToCSV']
+
+    def __init__(self, fe=None):
+        self.fe = FeatureExtraction.FeatureExtraction() if fe is None else fe
+        self.dataset = SyntheticDataset.SyntheticDataset()
+        self.numOfRecordings = 2
+        self.repeat = 3
+        self.tolerance = 0.25  # relative slowdown reported as a regression
+        self.minimumTime = 0.02  # CPU seconds, smaller slowdowns are measurement noise
+
+    def parameters(self):
+        '''
+            All the parameters the results depend on: the dataset and the extraction parameters
+        '''
+        return {'numOfRecordings': self.numOfRecordings, 'duration': self.dataset.duration, 'Fs': self.dataset.Fs,
+                'eventDensity': self.dataset.eventDensity, 'snrCount': self.dataset.snrCount,
+                'seed': self.dataset.seed, 'extraction': self.fe.cacheParameters()}
+
+    def run(self, path=None):
+        '''
+            Generates the dataset in path (by default in a temporary directory, removed at the end) and runs the
+            benchmark. It returns the results: a dict with the parameters, the audio seconds processed, the number
+            of rows, the CPU and wall seconds and the throughput of each stage and of the pipeline, and the peak RSS.
+        '''
+        temporary = path is None
+        if temporary:
+            path = tempfile.mkdtemp(prefix='benchmark')
+        path = os.path.join(path, '')
+
+        try:
+            # the dataset is generated by a child process, so its memory is not in the peak RSS
+            generator = multiprocessing.Process(target=self.dataset.generate, args=(path, self.numOfRecordings))
+            generator.start()
+            generator.join()
+            if generator.exitcode != 0:
+                raise RuntimeError("Error: the generation of the synthetic dataset failed.")
+
+            jobs = self.fe.listJobs(path, self.numOfRecordings + 1, self.dataset.snrCount)
+            audioSeconds = sum(N / float(Fs) for Fs, N in (audioBasicIO.readAudioInfo(job[1]) for job in jobs))
+
+            stages = {}
+            rows = 0
+            for r in range(self.repeat):
+                [times, rows] = self.runStages(jobs, os.path.join(path, 'stages.csv'))
+                times['pipeline'] = self.runPipeline(path, os.path.join(path, 'pipeline.csv'))
+                for name, (cpu, wall) in times.items():
+                    if name not in stages or cpu < stages[name]['cpu']:
+                        stages[name] = {'cpu': cpu, 'wall': wall}
+        finally:
+            if temporary:
+                shutil.rmtree(path, ignore_errors=True)
+
+        for name in stages:
+            stages[name]['throughput'] = audioSeconds / stages[name]['cpu'] if stages[name]['cpu'] > 0 else None
+
+        return {'parameters': self.parameters(), 'audioSeconds': audioSeconds, 'rows': rows, 'stages': stages,
+                'peakRSS': Instrumentation.peakRSS()}
+
+    def runStages(self, jobs, outputFile):
+        '''
+            Extracts the features of the jobs one stage at a time, it returns the (CPU, wall) seconds of each stage
+            and the number of rows
+        '''
+        fe = self.fe
+        fe.label = fe.buildLabel()
+        fe.dataPre.annotationCache.clear()  # every run parses the xml files
+        times = dict((name, [0.0, 0.0]) for name in self.stageNames)
+
+        def measure(name, function, *args):
+            cpu = time.process_time()
+            wall = time.perf_counter()
+            result = function(*args)
+            times[name][0] += time.process_time() - cpu
+            times[name][1] += time.perf_counter() - wall
+            return result
+
+        if os.path.exists(outputFile):
+            os.remove(outputFile)
+        output = fe.openOutput(outputFile, 'csv')
+        numRow = [0]
+        try:
+            for xml_path, wav_path, snr in jobs:
+                [Fs, x] = measure('readAudioFile', self.readSignal, wav_path)
+                eventsList = measure('segmentation', fe.dataPre.segmentSignal, xml_path, wav_path, x, Fs)
+                stFeatures = measure('stFeatureExtraction', fe.shortTermFeatures, eventsList, Fs)
+                [values, numOfFrames] = measure('aggregation', fe.aggregate, stFeatures)
+                feature = measure('metadata', fe.addMetadata, eventsList, values, numOfFrames, snr)
+                measure('writeToCSV', fe.writeOutput, output, feature, numRow)
+        finally:
+            fe.closeOutput(output)
+
+        return times, numRow[0]
+
+    def readSignal(self, wav_path):
+        [Fs, x] = audioBasicIO.readAudioFile(wav_path)
+        return Fs, np.array(x)
+
+    def runPipeline(self, path, outputFile):
+        '''
+            The (CPU, wall) seconds of a processDataset run over the dataset (in this process, with its threads)
+        '''
+        if os.path.exists(outputFile):
+            os.remove(outputFile)
+        self.fe.dataPre.annotationCache.clear()
+
+        cpu = time.process_time()
+        wall = time.perf_counter()
+        self.fe.processDataset(path, self.numOfRecordings + 1, self.dataset.snrCount, outputFile)
+        print("")
+        return [time.process_time() - cpu, time.perf_counter() - wall]
+
+    def float32Error(self, path=None):
+        '''
+            Generates the dataset in path (as run does) and processes it with computeDtype float64 and float32, with
+            and without sharedSpectra. For each output column it returns the largest |float32 - float64| over the
+            rows and the runs, divided by the standard deviation of the float64 column.
+        '''
+        temporary = path is None
+        if temporary:
+            path = tempfile.mkdtemp(prefix='benchmark')
+        path = os.path.join(path, '')
+
+        errors = {}
+        try:
+            self.dataset.generate(path, self.numOfRecordings)
+            for sharedSpectra in (False, True):
+                values = {}
+                for dtype in ('float64', 'float32'):
+                    fe = FeatureExtraction.FeatureExtraction()
+                    fe.sharedSpectra = sharedSpectra
+                    fe.computeDtype = dtype
+                    outputFile = os.path.join(path, dtype + '.csv')
+                    if os.path.exists(outputFile):
+                        os.remove(outputFile)
+                    fe.processDataset(path, self.numOfRecordings + 1, self.dataset.snrCount, outputFile)
+                    print("")
+                    [label, values[dtype]] = self.readColumns(outputFile)
+
+                deviation = np.std(values['float64'], axis=0)
+                error = np.max(np.abs(values['float32'] - values['float64']), axis=0)
+                error = error / np.where(deviation > 0, deviation, 1.0)
+                for name, e in zip(label, error.tolist()):
+                    errors[name] = max(errors.get(name, 0.0), e)
+        finally:
+            if temporary:
+                shutil.rmtree(path, ignore_errors=True)
+
+        return errors
+
+    def readColumns(self, outputFile):
+        '''
+            The names and the values (numOfRows x numOfColumns) of the feature columns of a .csv output
+        '''
+        numOfMetadata = 5  # target, frame, snr, id, background
+        with open(outputFile) as f:
+            rows = list(csv.reader(f))
+        label = rows[0][1:-numOfMetadata]
+        return label, np.array([[float(v) for v in row[1:-numOfMetadata]] for row in rows[1:]])
+
+    def reportFloat32Error(self, errors):
+        print("%-50s %14s" % ('column', 'error / std'))
+        for name in sorted(errors, key=errors.get, reverse=True):
+            print("%-50s %14.3g" % (name, errors[name]))
+
+    def saveBaseline(self, results, baselineFile):
+        with open(baselineFile, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    def loadBaseline(self, baselineFile):
+        with open(baselineFile) as f:
+            return json.load(f)
+
+    def compare(self, results, baseline):
+        '''
+            The regressions of results with respect to baseline: a list of messages, empty if there are none
+        '''
+        if results['parameters'] != baseline['parameters']:
+            raise ValueError("Error: the baseline was measured with different parameters.")
+
+        regressions = []
+        for name, stage in sorted(results['stages'].items()):
+            if name not in baseline['stages']:
+                continue
+            before = baseline['stages'][name]['cpu']
+            if stage['cpu'] > before * (1 + self.tolerance) and stage['cpu'] - before > self.minimumTime:
+                regressions.append("%s: %.3fs CPU, %.3fs in the baseline (%+.0f%%)"
+                                   % (name, stage['cpu'], before, 100 * (stage['cpu'] / before - 1)))
+
+        if results['peakRSS'] is not None and baseline['peakRSS'] is not None and \
+                results['peakRSS'] > baseline['peakRSS'] * (1 + self.tolerance):
+            regressions.append("peak RSS: %.1fMB, %.1fMB in the baseline" % (results['peakRSS'], baseline['peakRSS']))
+
+        return regressions
+
+    def report(self, results, baseline=None):
+        '''
+            Prints the results (and the change with respect to baseline)
+        '''
+        print("%.1f audio seconds, %d rows" % (results['audioSeconds'], results['rows']))
+        print("%-20s %10s %10s %16s %10s" % ('stage', 'CPU s', 'wall s', 'audio s/CPU s', 'baseline'))
+        for name in self.stageNames + ['pipeline']:
+            stage = results['stages'][name]
+            throughput = '-' if stage['throughput'] is None else '%.1f' % stage['throughput']
+            change = ''
+            if baseline is not None and name in baseline['stages'] and baseline['stages'][name]['cpu'] > 0:
+                change = '%+.0f%%' % (100 * (stage['cpu'] / baseline['stages'][name]['cpu'] - 1))
+            print("%-20s %10.3f %10.3f %16s %10s" % (name, stage['cpu'], stage['wall'], throughput, change))
+
+        if results['peakRSS'] is not None:
+            print("peak RSS: %.1fMB" % results['peakRSS'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Feature extraction benchmark on a synthetic Mivia-like dataset.')
+    parser.add_argument('--recordings', type=int, default=2, help='number of recordings')
+    parser.add_argument('--duration', type=float, default=60.0, help='seconds of each recording')
+    parser.add_argument('--fs', type=int, default=32000, help='sampling rate')
+    parser.add_argument('--density', type=float, default=6.0, help='events per minute')
+    parser.add_argument('--snr', type=int, default=6, help='snr variants of each recording')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic dataset')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each stage, the fastest is reported')
+    parser.add_argument('--path', help='directory of the generated dataset (default: a temporary directory)')
+    parser.add_argument('--baseline', help='baseline (json file) to compare the results with')
+    parser.add_argument('--save', help='saves the results as a baseline (json file)')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='relative slowdown reported as a regression')
+    parser.add_argument('--shared-spectra', action='store_true', help='benchmark the sharedSpectra extraction')
+    parser.add_argument('--float32-error', action='store_true',
+                        help='measure the error of the float32 computation instead of the timings')
+    args = parser.parse_args()
+
+    benchmark = Benchmark()
+    benchmark.numOfRecordings = args.recordings
+    benchmark.dataset.duration = args.duration
+    benchmark.dataset.Fs = args.fs
+    benchmark.dataset.eventDensity = args.density
+    benchmark.dataset.snrCount = args.snr
+    benchmark.dataset.seed = args.seed
+    benchmark.repeat = args.repeat
+    benchmark.tolerance = args.tolerance
+    benchmark.fe.sharedSpectra = args.shared_spectra
+
+    if args.float32_error:
+        benchmark.reportFloat32Error(benchmark.float32Error(args.path))
+        sys.exit(0)
+
+    results = benchmark.run(args.path)
+    baseline = benchmark.loadBaseline(args.baseline) if args.baseline else None
+    benchmark.report(results, baseline)
+    if args.save:
+        benchmark.saveBaseline(results, args.save)
+
+    if baseline is not None:
+        regressions = benchmark.compare(results, baseline)
+        for regression in regressions:
+            print("Regression: " + regression)
+        sys.exit(1 if len(regressions) > 0 else 0)
@@ -0,0 +1,130 @@
+import json
+import os
+
+import numpy as np
+
+
+class ColumnarDataset:
+    '''
+        Binary, column oriented storage of the extracted features (an alternative to the .csv output).
+
+        The dataset is a directory:
+            columns.json     labels, dtypes, number of rows and the dictionaries of ids and backgrounds
+            features.bin     the feature matrix (numRows x numFeatures), float64 or float32, row-major
+            target.bin       int8,  [0 == glass, 1 == gunshots, 2 == screams, 3 ==  other]
+            frame.bin        int32, number of subframes
+            snr.bin          int8,  snr in the range [1, 6]
+            id.bin           int32, code of the id (see columns.json)
+            background.bin   int32, code of the background (see columns.json)
+
+        Every file is a raw little-endian array, so new rows are appended at the end of the files
+        and the columns can be memory mapped by the loader (see load) without any parsing.
+        columns.json is rewritten after the rows are appended: rows beyond its numRows (an interrupted
+        append) are discarded when the dataset is opened again.
+    '''
+
+    metadata = [('target', '<i1'), ('frame', '<i4'), ('snr', '<i1'), ('id', '<i4'), ('background', '<i4')]
+
+    def __init__(self, path, labels, dtype='float64'):
+        self.path = path
+        self.labels = list(labels)
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        self.numRows = 0
+        self.ids = []
+        self.backgrounds = []
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        if os.path.exists(os.path.join(path, 'columns.json')):
+            with open(os.path.join(path, 'columns.json')) as f:
+                columns = json.load(f)
+            if columns['labels'] != self.labels or np.dtype(columns['dtype']) != self.dtype:
+                raise ValueError("Error: " + path + " stores different features, can not append.")
+            self.numRows = columns['numRows']
+            self.ids = columns['ids']
+            self.backgrounds = columns['backgrounds']
+
+        # drop the rows of an interrupted append
+        for name, itemSize in self.columnSizes():
+            with open(self.columnPath(name), 'ab') as f:
+                f.truncate(self.numRows * itemSize)
+
+        self.idCodes = dict((x, i) for i, x in enumerate(self.ids))
+        self.backgroundCodes = dict((x, i) for i, x in enumerate(self.backgrounds))
+        self.writeColumns()
+
+    def columnPath(self, name):
+        return os.path.join(self.path, name + '.bin')
+
+    def columnSizes(self):
+        sizes = [('features', self.dtype.itemsize * len(self.labels))]
+        return sizes + [(name, np.dtype(dtype).itemsize) for name, dtype in self.metadata]
+
+    def encode(self, codes, dictionary, value):
+        if value not in codes:
+            codes[value] = len(dictionary)
+            dictionary.append(value)
+        return codes[value]
+
+    def append(self, feature):
+        '''
+            Appends the rows produced by FeatureExtraction.extractFeatures
+            (the features followed by target, frame, snr, id and background)
+        '''
+        if len(feature) == 0:
+            return
+
+        numOfFeatures = len(self.labels)
+        columns = {
+            'features': np.array([row[:numOfFeatures] for row in feature], dtype=self.dtype),
+            'target': np.array([int(row[numOfFeatures]) for row in feature], dtype='<i1'),
+            'frame': np.array([int(row[numOfFeatures + 1]) for row in feature], dtype='<i4'),
+            'snr': np.array([int(row[numOfFeatures + 2]) for row in feature], dtype='<i1'),
+            'id': np.array([self.encode(self.idCodes, self.ids, row[numOfFeatures + 3]) for row in feature],
+                           dtype='<i4'),
+            'background': np.array([self.encode(self.backgroundCodes, self.backgrounds, row[numOfFeatures + 4])
+                                    for row in feature], dtype='<i4'),
+        }
+
+        for name, itemSize in self.columnSizes():
+            with open(self.columnPath(name), 'ab') as f:
+                f.write(columns[name].tobytes())
+
+        self.numRows += len(feature)
+        self.writeColumns()
+
+    def writeColumns(self):
+        columns = {'labels': self.labels, 'dtype': self.dtype.str, 'numRows': self.numRows,
+                   'metadata': [name for name, dtype in self.metadata],
+                   'ids': self.ids, 'backgrounds': self.backgrounds}
+        tmpPath = os.path.join(self.path, 'columns.json.tmp')
+        with open(tmpPath, 'w') as f:
+            json.dump(columns, f)
+        os.replace(tmpPath, os.path.join(self.path, 'columns.json'))  # atomic update
+
+    @staticmethod
+    def load(path, mmap=True):
+        '''
+            Loads a dataset written by ColumnarDataset. With mmap the columns are memory mapped (read-only).
+            It returns a dict with 'labels', 'features' (numRows x numFeatures), the metadata columns
+            ('target', 'frame', 'snr', 'id' and 'background' codes) and the dictionaries 'ids' and 'backgrounds'.
+        '''
+        with open(os.path.join(path, 'columns.json')) as f:
+            columns = json.load(f)
+
+        numRows = columns['numRows']
+        shapes = [('features', columns['dtype'], (numRows, len(columns['labels'])))]
+        shapes += [(name, dtype, (numRows,)) for name, dtype in ColumnarDataset.metadata]
+
+        dataset = {'labels': columns['labels'], 'ids': columns['ids'], 'backgrounds': columns['backgrounds']}
+        for name, dtype, shape in shapes:
+            filename = os.path.join(path, name + '.bin')
+            if numRows == 0:
+                dataset[name] = np.zeros(shape, dtype=dtype)
+            elif mmap:
+                dataset[name] = np.memmap(filename, dtype=dtype, mode='r', shape=shape)
+            else:
+                dataset[name] = np.fromfile(filename, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+        return dataset
@@ -1,6 +1,13 @@
+import collections
 import xml.etree.ElementTree as et
+
+import numpy as np
+
 import Event
+import Instrumentation
+import SegmentTable
 import audioBasicIO
+import audioFeatureExtraction
 
 
 class DatasetPreprocessing:
@@ -37,10 +44,21 @@ class DatasetPreprocessing:
         self.frameSize = 0.300
         self.overlap = 0.150
         self.tolerance = 0.2
+        self.channels = 1  # channels of the recordings, with 1 the multi-channel recordings are downmixed to mono
+        self.annotationCacheSize = 4  # number of recordings whose labels are kept (see annotations)
+        self.annotationCache = collections.OrderedDict()
 
     def parseXml(self, filename):
-        tree = et.parse(filename)
-        root = tree.getroot()
+        return self.parseRecording(filename)[1]
+
+    def parseRecording(self, filename):
+        '''
+            Parses the xml file of a recording. It returns (background, eventsList): the background is read from the
+            <background> items, so it is known also when the recording has no events.
+        '''
+        with Instrumentation.measure('xmlParse'):
+            tree = et.parse(filename)
+            root = tree.getroot()
 
         background = ""
         for j in root.findall("./background/item"):
@@ -62,54 +80,196 @@ class DatasetPreprocessing:
             event = Event.Event(className[:-4], target, start, stop, background)
             eventsList.append(event)
 
-        return eventsList
+        return background, eventsList
+
+    def labelWindows(self, eventsList, N):
+        '''
+            Vectorized labeling of all the windows of a signal of N samples (at self.Fs).
+            It returns three arrays, one item per retained window (dropped windows are skipped):
+                - positions, the first sample of the window
+                - targets, the int8 target [0 == glass, 1 == gunshots, 2 == screams, 3 ==  other]
+                - eventIndex, the index in eventsList of the event the window is compared with
+                  (it provides the background, and the id when the window is not '3')
+
+            The result is the same of the sequential scan, which compares each window with the current event
+            and moves to the next one (at most one per window) when the window goes past its end.
+        '''
+        Win = int(self.Fs*self.frameSize)
+        Step = int(self.Fs*self.overlap)
+        numOfWindows = (N - Win) // Step + 1 if N >= Win else 0
+        curPos = Step * np.arange(numOfWindows, dtype=np.int64)
+
+        if len(eventsList) == 0 or numOfWindows == 0:
+            return curPos, np.full(numOfWindows, 3, dtype=np.int8), np.zeros(numOfWindows, dtype=np.intp)
+
+        start = np.array([float(e.getStartSecond()) for e in eventsList])*self.Fs
+        stop = np.array([float(e.getStopSecond()) for e in eventsList])*self.Fs
+        eventTargets = np.array([int(e.getTarget()) for e in eventsList], dtype=np.int8)
+
+        winStart = curPos + self.tolerance*Win        # window start + 20%
+        winStop = curPos + Win - self.tolerance*Win   # window stop - 20%
+
+        # passed[k]: window where the scan leaves event k. It is the first window past the event end,
+        # but not before the scan has reached event k (one window after leaving event k-1):
+        # passed[k] = max(passed[k-1] + 1, pastEnd[k]) = k + max(0, max_{j<=k}(pastEnd[j] - j))
+        pastEnd = np.searchsorted(winStart, stop, side='right')
+        k = np.arange(len(eventsList))
+        passed = k + np.maximum.accumulate(np.maximum(pastEnd - k, 0))
+
+        # current event of each window (the scan stays on the last event)
+        index = np.minimum(np.searchsorted(passed, np.arange(numOfWindows), side='left'), len(eventsList)-1)
+        start = start[index]
+        stop = stop[index]
+
+        before = winStop < start
+        inside = ~before & (winStart >= start) & (winStop <= stop)
+        after = ~before & ~inside & (winStart > stop)
+
+        targets = np.where(inside, eventTargets[index], 3).astype(np.int8)
+        keep = before | inside | after  # partially overlapping windows are dropped
+
+        return curPos[keep], targets[keep], index[keep]
+
+    def annotations(self, xml_filename, N):
+        '''
+            Parses the xml file of a recording of N samples (at self.Fs) and labels its windows (see labelWindows).
+            The snr variants of a recording share the xml file and the length, so the result is cached: the xml file
+            is parsed and the windows are labeled once per recording (the last self.annotationCacheSize are kept).
+            It returns (eventsList, labels), labels is a dict of read-only arrays, one item per retained window:
+            'positions', 'targets', 'eventIndex', 'idCodes' and 'backgroundCodes', plus the dictionaries of the codes,
+            'eventIds' (code i + 1 is the id of event i, code 0 is the id of the background windows, see backgroundId)
+            and 'backgrounds'.
+        '''
+        key = (xml_filename, self.Fs, N, self.frameSize, self.overlap, self.tolerance)
+        if key in self.annotationCache:
+            self.annotationCache.move_to_end(key)
+            return self.annotationCache[key]
+
+        with Instrumentation.measure('segmentation'):
+            [background, eventsList] = self.parseRecording(xml_filename)
+            [positions, targets, eventIndex] = self.labelWindows(eventsList, N)
+
+        # dictionary encoding of ids and backgrounds (a recording has one background, shared by all its windows)
+        idCodes = np.where(targets == 3, 0, eventIndex + 1)
+        backgroundCodes = np.zeros(len(positions), dtype=np.int32)
+
+        labels = {'positions': positions, 'targets': targets, 'eventIndex': eventIndex, 'idCodes': idCodes,
+                  'backgroundCodes': backgroundCodes, 'eventIds': [event.getId() for event in eventsList],
+                  'backgrounds': [background]}
+        for name in ('positions', 'targets', 'eventIndex', 'idCodes', 'backgroundCodes'):
+            labels[name].setflags(write=False)  # shared by the tables of every snr variant
+
+        self.annotationCache[key] = (eventsList, labels)
+        while len(self.annotationCache) > self.annotationCacheSize:
+            self.annotationCache.popitem(last=False)
+        return self.annotationCache[key]
+
+    def backgroundId(self, wav_filename):
+        return "other" + wav_filename[-12:-4]
+
+    def channelSignal(self, x, wav_filename=''):
+        '''
+            The signal of the samples x of a wav file (numOfSamples, or numOfSamples x numOfChannels, as read by
+            audioBasicIO): with self.channels > 1 a (numOfChannels x numOfSamples) signal, whose channels are processed
+            together along the leading axis; with self.channels == 1 a mono signal, the mean of the channels (downmix).
+        '''
+        if self.channels == 1:
+            return x if x.ndim == 1 else x.mean(axis=1)
+
+        if x.ndim == 1 or x.shape[1] != self.channels:
+            raise ValueError("Error: " + str(wav_filename) + " has " + str(1 if x.ndim == 1 else x.shape[1]) +
+                             " channels, " + str(self.channels) + " expected.")
+        return np.ascontiguousarray(x.T)
+
+    def readSignals(self, wav_filename):
+        '''
+            Reads a wav file, or a list of wav files (e.g. the snr variants of a recording) with the same sampling rate
+            and length stacked in a (numOfFiles x numOfSamples) signal. It sets self.Fs and returns the signal.
+            The channels of the files are an axis before the samples (see channelSignal).
+        '''
+        if not isinstance(wav_filename, (list, tuple)):
+            [self.Fs, x] = audioBasicIO.readAudioFile(wav_filename)
+            return self.channelSignal(x, wav_filename)
+
+        signals = [audioBasicIO.readAudioFile(filename) for filename in wav_filename]
+        if len(set((Fs, len(x)) for Fs, x in signals)) > 1:
+            raise ValueError("Error: " + str(wav_filename) + " have different sampling rates or lengths.")
+        self.Fs = signals[0][0]
+        return np.stack([self.channelSignal(x, filename) for (Fs, x), filename in zip(signals, wav_filename)])
 
     def segmentation(self, xml_filename, wav_filename):
-        eventsList = self.parseXml(xml_filename)
+        '''
+            Segments a wav file and labels its windows, it returns a SegmentTable.
+            wav_filename can also be a list of wav files annotated by xml_filename, with the same sampling rate and
+            length: their signals are stacked (numOfFiles x numOfSamples) and share the segments.
+            The ids of the table are those of the first file (see backgroundId and SegmentTable.select).
+        '''
+        x = self.readSignals(wav_filename)
+        return self.segmentSignal(xml_filename, wav_filename, x, self.Fs)
+
+    def segmentSignal(self, xml_filename, wav_filename, x, Fs):
+        '''
+            Same as segmentation, for the signal x (at Fs) already read from wav_filename
+        '''
+        self.Fs = Fs
+        [eventsList, labels] = self.annotations(xml_filename, x.shape[-1])
 
-        [self.Fs, x] = audioBasicIO.readAudioFile(wav_filename)
+        return self.buildTable(labels, wav_filename, x)
+
+    def segmentationBlocks(self, xml_filename, wav_filename, blockDuration=60.0, normalization=False,
+                           dtype=np.float64):
+        '''
+            Same as segmentation, but the wav file is read in blocks of (about) blockDuration seconds and a
+            SegmentTable is yielded for each block, with the windows starting in it: the memory used does not
+            depend on the length of the recording. Consecutive blocks overlap by one window minus one step,
+            so every window is entirely in the block where it starts.
+            With normalization the DC and the peak of the whole recording (in the dtype precision) are computed
+            first, in a pass over the blocks, and stored in every table (see SegmentTable.normalization): the blocks
+            are normalized as the whole recording is (see audioFeatureExtraction.stPrepareSignal).
+        '''
+        wav_filenames = wav_filename if isinstance(wav_filename, (list, tuple)) else [wav_filename]
+        infos = [audioBasicIO.readAudioInfo(filename) for filename in wav_filenames]
+        if len(set(infos)) > 1:
+            raise ValueError("Error: " + str(wav_filename) + " have different sampling rates or lengths.")
+        [self.Fs, N] = infos[0]
 
-        segmentedFileList = []
-        curPos = 0
-        N = len(x)
         Win = int(self.Fs*self.frameSize)
         Step = int(self.Fs*self.overlap)
-        index = 0
-
-        while curPos + Win - 1 < N:
-            curFrame = x[curPos:curPos + Win]
-
-            curEvent = eventsList[index]
-            start = float(curEvent.getStartSecond())*self.Fs
-            stop = float(curEvent.getStopSecond())*self.Fs
-
-            # debug print
-            # print('start win ' + str(curPos))
-            # print('start win +20% ' + str(curPos + self.tolerance*Win))
-            # print('stop win ' + str(curPos + Win))
-            # print('stop win -20% ' + str(curPos + Win - self.tolerance*Win))
-            #
-            # print('start event ' + str(start))
-            # print('stop event ' + str(stop))
-
-            if curPos + Win - self.tolerance*Win < start:
-                target = "3"
-                backgorundEvent = Event.Event("other" + wav_filename[-12:-4], target, None, None,
-                                              curEvent.getBackground(), curFrame)
-                segmentedFileList.append(backgorundEvent)
-            elif curPos + self.tolerance*Win >= start and curPos + Win - self.tolerance*Win <= stop:
-                relevantEvent = Event.Event(curEvent.getId(), curEvent.getTarget(),
-                                            None, None,
-                                            curEvent.getBackground(), curFrame)
-                segmentedFileList.append(relevantEvent)
-            elif curPos + self.tolerance*Win > stop:
-                if index < len(eventsList)-1:
-                    index += 1
-                target = "3"
-                backgorundEvent = Event.Event("other"+wav_filename[-12:-4], target, None, None,
-                                              curEvent.getBackground(), curFrame)
-                segmentedFileList.append(backgorundEvent)
-
-            curPos = curPos + Step
-
-        return segmentedFileList
\ No newline at end of file
+        [eventsList, labels] = self.annotations(xml_filename, N)
+        positions = labels['positions']
+
+        blockSize = max(int(self.Fs*blockDuration) // Step, 1) * Step  # windows start at multiples of Step
+        wholeNormalization = None
+        if normalization:
+            signals = (x for start, x in self.readBlocks(wav_filenames, blockSize, 0))
+            wholeNormalization = audioFeatureExtraction.stSignalNormalization(signals, dtype)
+
+        for start, x in self.readBlocks(wav_filenames, blockSize, max(Win - Step, 0)):
+            first, last = np.searchsorted(positions, [start, start + blockSize])
+            table = self.buildTable(labels, wav_filename, x, first, last, origin=start)
+            table.normalization = wholeNormalization
+            yield table
+
+    def readBlocks(self, wav_filenames, blockSize, overlap):
+        '''
+            Reads wav files with the same sampling rate and length in blocks (see audioBasicIO.readAudioBlocks), it
+            yields (start, x) for each block: x is the block of the only file, or the blocks of the files stacked
+        '''
+        readers = [audioBasicIO.readAudioBlocks(filename, blockSize, overlap) for filename in wav_filenames]
+        for blocks in zip(*readers):
+            signals = [self.channelSignal(block, filename)
+                       for (blockStart, block), filename in zip(blocks, wav_filenames)]
+            yield (blocks[0][0], signals[0] if len(signals) == 1 else np.stack(signals))
+
+    def buildTable(self, labels, wav_filename, x, first=0, last=None, origin=0):
+        '''
+            The SegmentTable of the windows first:last of labels (see annotations), x is the signal from sample origin
+        '''
+        if isinstance(wav_filename, (list, tuple)):
+            wav_filename = wav_filename[0]
+        ids = [self.backgroundId(wav_filename)] + labels['eventIds']
+        windows = slice(first, last)
+
+        return SegmentTable.SegmentTable(x, self.Fs, int(self.Fs*self.frameSize), labels['positions'][windows] - origin,
+                                         labels['targets'][windows], labels['idCodes'][windows], ids,
+                                         labels['backgroundCodes'][windows], labels['backgrounds'], origin)
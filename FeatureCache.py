@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import pickle
+
+
+class FeatureCache:
+    '''
+        Persistent, content addressed cache of the features of a (xml, wav, snr) job.
+
+        The key is a hash of the content of the wav and xml files and of every parameter the rows depend on (the
+        extraction parameters and the metadata not in the files, e.g. the id of the background rows, which comes
+        from the wav file name), so a cached result is reused whatever the output is, and it is never reused if
+        the data or the parameters change. Each entry is a file in the cache directory, written and read a block of rows at a time
+        (see append, commit and getBlocks), so an entry is never held in memory as a whole; when the total size
+        exceeds maxSize the least recently used entries are evicted (the access time is tracked through the file
+        modification time).
+    '''
+
+    version = 3  # part of every key: increase it when the extraction code changes its results
+
+    def __init__(self, path, maxSize=2 ** 30):
+        self.path = path
+        self.maxSize = maxSize
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def key(self, filenames, parameters):
+        h = hashlib.sha256()
+        h.update(json.dumps({'version': self.version, 'parameters': parameters}, sort_keys=True).encode('utf-8'))
+        for filename in filenames:
+            with open(filename, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def entryPath(self, key):
+        return os.path.join(self.path, key + '.pkl')
+
+    def getBlocks(self, key):
+        '''
+            Returns a generator of the blocks of rows of the cached value, or None if the key is not in the cache
+        '''
+        try:
+            f = open(self.entryPath(key), 'rb')
+            os.utime(self.entryPath(key), None)  # most recently used
+        except (IOError, OSError):
+            return None
+        return self.readBlocks(f)
+
+    def readBlocks(self, f):
+        with f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+    def tmpPath(self, key):
+        return self.entryPath(key) + '.' + str(os.getpid()) + '.tmp'
+
+    def append(self, key, value, new=False):
+        '''
+            Appends a block of rows to the entry of key, it is in the cache once committed (see commit).
+            new starts the entry from scratch.
+        '''
+        with open(self.tmpPath(key), 'wb' if new else 'ab') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def commit(self, key):
+        os.replace(self.tmpPath(key), self.entryPath(key))  # atomic, concurrent writers are safe
+        self.evict()
+
+    def discard(self, key):
+        '''
+            Removes the entry of key being appended, if any
+        '''
+        try:
+            os.remove(self.tmpPath(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.pkl'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue  # evicted by another process
+            entries.append((st.st_mtime, st.st_size, name))
+
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):  # least recently used first
+            if total <= self.maxSize:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
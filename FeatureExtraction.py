@@ -1,10 +1,56 @@
+import argparse
+import collections
+import copy
+import glob
+import json
+import multiprocessing
+import os
+import shutil
 import sys
 import time
 
 import numpy as np
 
+import ColumnarDataset
 import DatasetPreprocessing as pre
+import FeatureCache
+import Instrumentation
+import JobManifest
+import SegmentTable
+import audioBasicIO
 import audioFeatureExtraction
+import pipelineIO
+
+
+def medianAbsoluteDeviation(F):
+    '''
+        Median and median absolute deviation of the features (along the last axis, the frames)
+    '''
+    median = np.median(F, axis=-1)
+    median_absolute_deviation = np.median(np.abs(F - median[..., np.newaxis]), axis=-1)
+    return np.stack((median, median_absolute_deviation), axis=-1)
+
+
+def meanStandardDeviation(F):
+    '''
+        Mean and standard deviation of the features (along the last axis, the frames)
+    '''
+    return np.stack((np.mean(F, axis=-1), np.std(F, axis=-1)), axis=-1)
+
+
+def percentiles(F):
+    '''
+        10th, 50th and 90th percentile of the features (along the last axis, the frames)
+    '''
+    return np.moveaxis(np.percentile(F, [10, 50, 90], axis=-1), 0, -1)
+
+
+# aggregation name: (function, statistic names used in the .csv header)
+aggregations = {
+    'median': (medianAbsoluteDeviation, ['median', 'median_absolute_deviation']),
+    'mean': (meanStandardDeviation, ['mean', 'standard_deviation']),
+    'percentile': (percentiles, ['percentile10', 'percentile50', 'percentile90']),
+}
 
 
 class FeatureExtraction:
@@ -49,6 +95,27 @@ class FeatureExtraction:
             -MFCCs12_median, MFCCs12_median_absolute_deviation
             -MFCCs13_median, MFCCs13_median_absolute_deviation
 
+        With computeDtype = 'float32' the features are computed in single precision, from the PCM samples to the
+        aggregated columns (see audioFeatureExtraction.stFeatureExtraction for the error budget); set outputDtype
+        to 'float32' too to store them in a columnar output without conversion.
+
+        selectFeatures() restricts the extraction to a subset of these features (the others are never computed,
+        with time-domain features only no fft is computed at all) and rebuilds the .csv header to match.
+
+        With sharedSpectra enabled the short-term analysis is run once over the whole recording and each segment
+        is built from the shared frames: every 150ms frame belongs to two segments, so this roughly halves the
+        spectral work. By default (segmentNormalization) each segment is still normalized on its own (DC removal
+        and peak normalization) and the output does not change; disabling it normalizes the whole recording once.
+
+        The xml file of a recording is parsed and its windows are labeled once for all its snr variants
+        (see DatasetPreprocessing.annotations). With stackSnr the snr variants are also processed as one batch:
+        their signals are stacked and every short-term analysis call covers all of them (the output does not change).
+
+        With blockDuration the recordings are read and processed in blocks of (about) that many seconds: in a serial
+        run (resumable or not, with or without cache) the rows are written, stored in the parts and in the cache
+        block by block, so the memory used does not depend on the length of the recordings. With stackSnr or more
+        than one worker the rows of a job (not its samples) are still held in memory until the job ends.
+
         The method processTrainDataset() allows to process the training data of Mivia Audio Events Dataset.
         It parse the metadata within the xml files provided with the dataset in order to do the segmentation.
 
@@ -76,47 +143,133 @@ class FeatureExtraction:
         self.frameSize = 0.150
         self.frameStep = 0.075  # 50% overlap
         self.discard = 21  # number of original features to retain
-        self.label = ['Zero_Crossing_Rate_median', 'Zero_Crossing_Rate_median_absolute_deviation',
-                      'Energy_median', 'Energy_median_absolute_deviation',
-                      'Entropy_of_Energy_median', 'Entropy_of_Energy_median_absolute_deviation',
-                      'Spectral_Centroid_median', 'Spectral_Centroid_median_absolute_deviation',
-                      'Spectral_Spread_median',  'Spectral_Spread_median_absolute_deviation',
-                      'Spectral_Entropy_median', 'Spectral_Entropy_median_absolute_deviation',
-                      'Spectral_Flux_median', 'Spectral_Flux_median_absolute_deviation',
-                      'Spectral_Rolloff_median',  'Spectral_Rolloff_median_absolute_deviation',
-                      'MFCCs1_median', 'MFCCs1_median_absolute_deviation',
-                      'MFCCs2_median', 'MFCCs2_median_absolute_deviation',
-                      'MFCCs3_median', 'MFCCs3_median_absolute_deviation',
-                      'MFCCs4_median', 'MFCCs4_median_absolute_deviation',
-                      'MFCCs5_median', 'MFCCs5_median_absolute_deviation',
-                      'MFCCs6_median', 'MFCCs6_median_absolute_deviation',
-                      'MFCCs7_median', 'MFCCs7_median_absolute_deviation',
-                      'MFCCs8_median', 'MFCCs8_median_absolute_deviation',
-                      'MFCCs9_median', 'MFCCs9_median_absolute_deviation',
-                      'MFCCs10_median', 'MFCCs10_median_absolute_deviation',
-                      'MFCCs11_median', 'MFCCs11_median_absolute_deviation',
-                      'MFCCs12_median', 'MFCCs12_median_absolute_deviation',
-                      'MFCCs13_median', 'MFCCs13_median_absolute_deviation',
-                      'target', 'frame', 'snr', 'id', 'background']
-
-    def extractFeatures(self, eventsList, Fs, snr):
+        self.sharedSpectra = False  # run the short-term analysis once over the whole recording
+        self.segmentNormalization = True  # with sharedSpectra, normalize each segment on its own (same output)
+        self.outputDtype = 'float64'  # features dtype of the columnar output
+        self.computeDtype = 'float64'  # precision of the feature computation, 'float32' halves the memory traffic
+        self.blockDuration = None  # if set, long recordings are processed in blocks of (about) this many seconds
+        self.cache = None  # FeatureCache used to skip the jobs already processed
+        self.prefetch = 2  # reader/writer threads: items read ahead and waiting to be written (0 disables them)
+        self.stackSnr = False  # process the snr variants of a recording as one stacked batch (see groupJobs)
+        self.aggregation = 'median'  # statistics computed over the frames of each segment (see aggregations)
+        self.instrumentation = None  # Instrumentation recording the time of each stage of the runs (see summary, save)
+        self.featureNames = list(audioFeatureExtraction.featureNames)
+        self.label = self.buildLabel()
+
+    def selectFeatures(self, names):
+        '''
+            Selects the features to extract, e.g. ['Energy', 'MFCCs1', 'MFCCs2']: the other ones are never computed.
+            The columns follow the order of names, the .csv header (self.label) is rebuilt to match.
+        '''
+        self.featureNames = audioFeatureExtraction.stFeatureSelection(names)
+        self.discard = len(self.featureNames)
+        self.label = self.buildLabel()
+
+    def selectedFeatures(self):
+        return self.featureNames[:self.discard]
+
+    def setChannels(self, channels):
+        '''
+            Sets the channels of the recordings (see DatasetPreprocessing.channelSignal): with channels > 1 all the
+            channels are processed at once and each row holds the features of every channel, channel after channel;
+            with 1 the multi-channel recordings are downmixed to mono. The .csv header (self.label) is rebuilt to match.
+        '''
+        self.dataPre.channels = int(channels)
+        self.label = self.buildLabel()
+
+    def buildLabel(self):
+        '''
+            Builds the .csv header: one column for each statistic of each feature (of each channel, prefixed by ch<k>_,
+            with more than one channel), followed by the metadata
+        '''
+        statistics = aggregations[self.aggregation][1]
+        label = [name + '_' + statistic for name in self.selectedFeatures() for statistic in statistics]
+        if self.dataPre.channels > 1:
+            label = ['ch' + str(k + 1) + '_' + name for k in range(self.dataPre.channels) for name in label]
+        return label + ['target', 'frame', 'snr', 'id', 'background']
+
+    def extractFeatures(self, eventsList, Fs, snr, signal=None):
+        stFeatures = self.shortTermFeatures(eventsList, Fs, signal)
+        return self.buildRows(eventsList, stFeatures, snr)
+
+    def extractFeaturesBatch(self, eventsList, Fs, jobs):
+        '''
+            Extracts the features of the snr variants of a recording, stacked in the signal of a SegmentTable
+            (numOfJobs x numOfSamples, see DatasetPreprocessing.segmentation): the segments, their labels and
+            the short-term analysis calls are shared. It returns the rows of each (xml, wav, snr) job.
+        '''
+        stFeatures = self.shortTermFeatures(eventsList, Fs)
+
         feature = []
+        for c, (xml_path, wav_path, snr) in enumerate(jobs):
+            variant = eventsList.select(c, [self.dataPre.backgroundId(wav_path)] + eventsList.ids[1:])
+            if isinstance(stFeatures, np.ndarray):
+                F = stFeatures[:, c]
+            else:
+                F = [segment[c] for segment in stFeatures]
+            feature.append(self.buildRows(variant, F, snr))
+
+        return feature
+
+    def extractClips(self, clips, Fs):
+        '''
+            Extracts the features of a batch of clips of any length (e.g. the requests of an online classifier), each
+            clip is a segment: its row is the one extractFeatures computes for an Event with the clip data, without
+            the metadata (within floating point round-off). The windows of all the clips are packed in one frame matrix
+            and processed with vectorized calls (see audioFeatureExtraction.stFeatureExtractionClips), and the clips
+            with the same number of windows are aggregated together: one call and one array for the whole batch,
+            in about the time of extracting the clips one at a time.
+            It returns a contiguous array (numOfClips x 42, i.e. numOfFeatures * numOfStatistics) in the precision of
+            self.computeDtype; the row of a clip shorter than a short-term window is NaN.
+        '''
+        [F, frameOffsets] = audioFeatureExtraction.stFeatureExtractionClips(clips, Fs, self.frameSize * Fs,
+                                                                            self.frameStep * Fs,
+                                                                            features=self.selectedFeatures(),
+                                                                            dtype=self.computeDtype)
+
+        numOfColumns = F.shape[0] * len(aggregations[self.aggregation][1])
+        values = np.full((len(frameOffsets) - 1, numOfColumns), np.nan, dtype=F.dtype)
+        index = np.flatnonzero(np.diff(frameOffsets) > 0)
+        if len(index) > 0:
+            values[index] = self.aggregate([F[:, frameOffsets[i]:frameOffsets[i + 1]] for i in index])[0]
+
+        return values
+
+    def shortTermFeatures(self, eventsList, Fs, signal=None):
+        '''
+            The short-term features of each segment (... x numOfFeatures x numOfFrames, the leading axes are those
+            of a stacked signal): a list, or an array (numOfSegments x ...) with sharedSpectra
+        '''
+        if self.sharedSpectra and (signal is not None or isinstance(eventsList, SegmentTable.SegmentTable)):
+            return self.shortTermFeaturesShared(eventsList, signal, Fs)
+
+        stFeatures = []
         for event in eventsList:
             frame = event.getData()
 
-            F = audioFeatureExtraction.stFeatureExtraction(frame, Fs, self.frameSize * Fs, self.frameStep * Fs)
-            raw_feature = F[:self.discard, :].T
+            with Instrumentation.measure('stFeatureExtraction'):
+                F = audioFeatureExtraction.stFeatureExtraction(frame, Fs, self.frameSize * Fs, self.frameStep * Fs,
+                                                               features=self.selectedFeatures(),
+                                                               dtype=self.computeDtype)
+            stFeatures.append(F)
+
+        return stFeatures
 
-            tmp = []
-            for j in range(0, raw_feature.shape[1]):  # compute median and med for each columns
-                feature_column = raw_feature[:, j]
-                median = np.median(raw_feature[:, j])
-                median_absolute_deviation = np.median(np.abs(feature_column - median))
-                tmp.append(median)
-                tmp.append(median_absolute_deviation)
+    def buildRows(self, eventsList, stFeatures, snr):
+        '''
+            Aggregates the short-term features of the segments and appends the metadata of each segment
+        '''
+        [values, numOfFrames] = self.aggregate(stFeatures)
+        return self.addMetadata(eventsList, values, numOfFrames, snr)
 
+    def addMetadata(self, eventsList, values, numOfFrames, snr):
+        '''
+            The rows of the segments: their aggregated features (see aggregate) followed by their metadata
+        '''
+        feature = []
+        for event, tmp, n in zip(eventsList, values.tolist(), numOfFrames.tolist()):
             tmp.append(event.getTarget())  # add class label
-            tmp.append(raw_feature.shape[0])  # add number of frame per signal
+            tmp.append(n)  # add number of frame per signal
             tmp.append(snr)  # add snr
             tmp.append(event.getId())  # add id
             tmp.append(event.getBackground())  # add background type
@@ -124,6 +277,66 @@ class FeatureExtraction:
 
         return feature
 
+    def shortTermFeaturesShared(self, eventsList, signal, Fs):
+        '''
+            Computes the short-term features of all the segments (numOfSegments x ... x numOfFeatures x numOfFrames),
+            running the short-term analysis once over the whole recording:
+            the 150ms frames shared by two overlapping 300ms segments are transformed only once.
+            The segments of a SegmentTable are located through their offsets, the Event objects
+            through their start second in signal.
+        '''
+        if len(eventsList) == 0:
+            return []
+
+        normalization = None
+        if isinstance(eventsList, SegmentTable.SegmentTable):
+            signal = eventsList.signal
+            segOffsets = eventsList.offsets
+            segWin = eventsList.Win
+            normalization = eventsList.normalization
+        else:
+            segOffsets = [int(round(float(event.getStartSecond()) * Fs)) for event in eventsList]
+            segWin = len(eventsList[0].getData())
+
+        with Instrumentation.measure('stFeatureExtraction'):
+            F = audioFeatureExtraction.stFeatureExtractionSegments(signal, Fs, self.frameSize * Fs,
+                                                                   self.frameStep * Fs, segOffsets, segWin,
+                                                                   segmentNormalization=self.segmentNormalization,
+                                                                   features=self.selectedFeatures(),
+                                                                   dtype=self.computeDtype,
+                                                                   normalization=normalization)
+        if F.ndim > 3:
+            F = np.moveaxis(F, -3, 0)  # segments first, as the list of the per-segment path
+        return F
+
+    def aggregate(self, stFeatures):
+        '''
+            Summarizes the short-term features of each segment (numOfFeatures x numOfFrames, or numOfChannels x
+            numOfFeatures x numOfFrames) with the statistics of self.aggregation. All the segments with the same number
+            of frames are stacked and aggregated with a single vectorized call.
+            It returns a matrix (numOfSegments x numOfFeatures * numOfStatistics, times numOfChannels), with the
+            statistics of each feature in consecutive columns (channel after channel), and the number of frames of
+            each segment.
+        '''
+        [function, statistics] = aggregations[self.aggregation]
+        Instrumentation.count('segments', len(stFeatures))
+
+        with Instrumentation.measure('aggregation') as stage:
+            if isinstance(stFeatures, np.ndarray):
+                numOfFrames = np.full(len(stFeatures), stFeatures.shape[-1], dtype=int)
+                values = function(stFeatures).reshape(len(stFeatures), -1)
+            else:
+                numOfFrames = np.array([F.shape[-1] for F in stFeatures], dtype=int)
+                numOfColumns = int(np.prod(stFeatures[0].shape[:-1])) * len(statistics) if len(stFeatures) > 0 else 0
+                dtype = stFeatures[0].dtype if len(stFeatures) > 0 else np.float64
+                values = np.zeros((len(stFeatures), numOfColumns), dtype=dtype)
+                for n in np.unique(numOfFrames):
+                    index = np.flatnonzero(numOfFrames == n)
+                    values[index] = function(np.stack([stFeatures[i] for i in index])).reshape(len(index), -1)
+            stage.allocated(values.nbytes)
+
+        return values, numOfFrames
+
     def update_progress(self, progress):
         barLength = 100  # Modify this to change the length of the progress bar
         status = ""
@@ -144,6 +357,9 @@ class FeatureExtraction:
         sys.stdout.flush()
 
     def writeToCSV(self, feature, numRow, numCol, file):
+        if len(feature) == 0:
+            return
+
         tmp = []
         for row in feature:
             tmp.append(np.append(numRow, row))
@@ -154,17 +370,180 @@ class FeatureExtraction:
 
         np.savetxt(file, tmp, delimiter=",", fmt=fmt)
 
-    def processDataset(self, path, wavNum, snrRange, outputFile):
-        file = open(outputFile, 'ab')
+    def processGroup(self, group, items=None):
+        '''
+            The features of each job of a group (see processGroupBlocks), a list of rows for each job
+        '''
+        feature = [[] for job in group]
+        for i, block in self.processGroupBlocks(group, items):
+            feature[i].extend(block)
+        return feature
 
-        header = ","
-        for x in self.label:
-            header += x + ","
+    def processGroupRecorded(self, group):
+        '''
+            processGroup in a worker process, with the records of its stages (see Instrumentation.records)
+        '''
+        instrumentation = Instrumentation.Instrumentation()
+        instrumentation.start()
+        try:
+            feature = self.processGroup(group)
+        finally:
+            instrumentation.stop()
+        return feature, instrumentation.records()
 
-        file.write((header[:len(header)-1]+'\n').encode('ascii'))  # write .csv header
+    def mergeRecords(self, results):
+        '''
+            Merges the records of the workers (see processGroupRecorded) into the active Instrumentation
+        '''
+        for feature, records in results:
+            Instrumentation.collector.merge(records)
+            yield feature
 
-        total = (wavNum-1)*float(snrRange)
-        cont = [0]
+    def cacheParameters(self):
+        '''
+            All the parameters the features depend on (see FeatureCache)
+        '''
+        parameters = {'segmentation': self.segmentation, 'frameSize': self.frameSize, 'frameStep': self.frameStep,
+                'discard': self.discard, 'featureNames': self.featureNames, 'aggregation': self.aggregation,
+                'sharedSpectra': self.sharedSpectra, 'segmentNormalization': self.segmentNormalization,
+                'segmentFrameSize': self.dataPre.frameSize, 'overlap': self.dataPre.overlap,
+                'tolerance': self.dataPre.tolerance}
+        if np.dtype(self.computeDtype) != np.float64:
+            parameters['computeDtype'] = np.dtype(self.computeDtype).name  # the float64 keys do not change
+        if self.dataPre.channels != 1:
+            parameters['channels'] = self.dataPre.channels  # the mono keys do not change
+        if self.blockDuration is not None and self.sharedSpectra and not self.segmentNormalization:
+            parameters['blockDuration'] = self.blockDuration  # only there the blocks change the round-off
+        return parameters
+
+    def processGroupBlocks(self, group, items=None):
+        '''
+            Yields (i, rows) for each block of the features of the i-th (xml, wav, snr) job of a group of jobs with
+            the same xml file (see groupJobs). With self.blockDuration the wavs are read, segmented and processed in
+            blocks, so the memory used does not depend on their length; the stacked snr variants of a recording
+            yield the rows of a block for each of them. The output is the same of the whole-file run, except with
+            sharedSpectra and no segmentNormalization: the whole recording is normalized with its DC and peak,
+            computed in a first pass over the blocks, and the features differ within floating point round-off.
+            With self.cache the features are looked up in (and then stored into) the cache, a block at a time.
+            items are the results of the reading stage of the group (see readGroup), by default it is run here.
+        '''
+        if items is None:
+            items = self.readGroup(group)
+
+        keys = {}
+        started = set()  # jobs whose cache entry has blocks
+        try:
+            for kind, value in items:
+                if kind == 'key':
+                    [i, keys[i]] = value
+                elif kind == 'cached':  # no decoding, no fft
+                    [i, cachedBlocks] = value
+                    del keys[i]
+                    for block in cachedBlocks:
+                        yield (i, block)
+                else:
+                    [indices, eventsList] = value
+                    if len(indices) == 1:
+                        blocks = [self.extractFeatures(eventsList, eventsList.Fs, snr=group[indices[0]][2])]
+                    else:
+                        blocks = self.extractFeaturesBatch(eventsList, eventsList.Fs, [group[i] for i in indices])
+                    for i, block in zip(indices, blocks):
+                        if i in keys:
+                            self.cache.append(keys[i], block, new=i not in started)
+                            started.add(i)
+                        yield (i, block)
+
+            for i in sorted(keys):
+                if i not in started:
+                    self.cache.append(keys[i], [], new=True)
+                    started.add(i)
+                self.cache.commit(keys[i])
+                started.remove(i)
+        finally:
+            for i in started:
+                self.cache.discard(keys[i])  # interrupted, the entry is incomplete
+
+    def readGroup(self, group, load=False):
+        '''
+            Reading stage of a group of (xml, wav, snr) jobs with the same xml file, everything but the feature
+            computation. It yields
+                - ('key', (i, cache key)) for the i-th job, with self.cache
+                - ('cached', (i, blocks)) for the i-th job, if its features are in self.cache: a generator of
+                  the blocks of its rows (see FeatureCache.getBlocks)
+                - ('segments', (indices, SegmentTable)) for each block of the wavs of the jobs in indices: the wavs
+                  of a group with the same sampling rate and length are stacked and share the segments
+            With load the samples are read in memory (a memory mapped wav is read when the features are computed).
+        '''
+        todo = []
+        for i, (xml_path, wav_path, snr) in enumerate(group):
+            if self.cache is not None:
+                parameters = self.cacheParameters()
+                parameters['snr'] = snr
+                parameters['backgroundId'] = self.dataPre.backgroundId(wav_path)  # the id of the background rows
+                key = self.cache.key([wav_path, xml_path], parameters)
+                yield ('key', (i, key))
+
+                blocks = self.cache.getBlocks(key)
+                if blocks is not None:
+                    yield ('cached', (i, blocks))
+                    continue
+            todo.append(i)
+
+        batches = {}
+        for i in todo:
+            info = audioBasicIO.readAudioInfo(group[i][1]) if len(todo) > 1 else None
+            batches.setdefault(info, []).append(i)
+
+        for indices in batches.values():
+            xml_path = group[indices[0]][0]
+            wav_path = group[indices[0]][1] if len(indices) == 1 else [group[i][1] for i in indices]
+            if self.blockDuration is None:
+                tables = [self.dataPre.segmentation(xml_path, wav_path)]
+            else:
+                # without segment normalization the blocks are normalized as the whole recording
+                normalization = self.sharedSpectra and not self.segmentNormalization
+                tables = self.dataPre.segmentationBlocks(xml_path, wav_path, self.blockDuration, normalization,
+                                                         self.computeDtype)
+            for eventsList in tables:
+                if load and isinstance(eventsList.signal, np.memmap):
+                    with Instrumentation.measure('load') as stage:
+                        eventsList.signal = np.array(eventsList.signal)
+                        stage.allocated(eventsList.signal.nbytes)
+                yield ('segments', (indices, eventsList))
+
+    def readGroups(self, groups):
+        '''
+            Reading stage of a sequence of groups: the items of each group (see readGroup), followed by ('end', None)
+        '''
+        for group in groups:
+            for item in self.readGroup(group, load=True):
+                yield item
+            yield ('end', None)
+
+    def groupItems(self, items):
+        '''
+            Yields the items of the current group from the stream produced by readGroups
+        '''
+        for kind, value in items:
+            if kind == 'end':
+                return
+            yield (kind, value)
+
+    def groupJobs(self, jobs):
+        '''
+            Splits the jobs in groups processed together: with self.stackSnr the consecutive jobs with the same xml file
+            (the snr variants of a recording, see readGroup), otherwise one group for each job
+        '''
+        groups = []
+        for job in jobs:
+            if self.stackSnr and len(groups) > 0 and groups[-1][0][0] == job[0]:
+                groups[-1].append(job)
+            else:
+                groups.append([job])
+        return groups
+
+    def listJobs(self, path, wavNum, snrRange):
+        jobs = []
         for i in range(1, wavNum):  # process all wav
             if i < 10:
                 xml_path = path + '0000' + str(i) + '.xml'
@@ -174,54 +553,484 @@ class FeatureExtraction:
                 wav_base_path = path + 'sounds/000' + str(i)
 
             for j in range(1, snrRange+1):  # process differents snr  1=30db ... 6=5db
-                eventsList = self.dataPre.segmentation(xml_path, wav_base_path + '_' + str(j) + '.wav')
-                feature = self.extractFeatures(eventsList, self.dataPre.Fs, snr=j)
+                jobs.append((xml_path, wav_base_path + '_' + str(j) + '.wav', j))
+
+        return jobs
+
+    def planJobs(self, path, snrRange=None):
+        '''
+            Lists the (xml, wav, snr) jobs of a dataset from its files: every path/*.xml with its
+            path/sounds/<name>_<snr>.wav files (snr <= snrRange, if given), sorted by xml name and snr.
+        '''
+        jobs = []
+        for xml_path in sorted(glob.glob(os.path.join(path, '*.xml'))):
+            name = os.path.splitext(os.path.basename(xml_path))[0]
+            snrs = []
+            for wav_path in glob.glob(os.path.join(path, 'sounds', name + '_*.wav')):
+                snr = os.path.splitext(wav_path)[0][len(os.path.join(path, 'sounds', name + '_')):]
+                if snr.isdigit() and (snrRange is None or int(snr) <= snrRange):
+                    snrs.append((int(snr), wav_path))
+            for snr, wav_path in sorted(snrs):
+                jobs.append((xml_path, wav_path, snr))
+
+        return jobs
+
+    def savePlan(self, jobs, planFile):
+        with open(planFile, 'w') as f:
+            json.dump({'jobs': jobs}, f, indent=1)
+
+    def loadPlan(self, planFile):
+        with open(planFile) as f:
+            return [tuple(job) for job in json.load(f)['jobs']]
+
+    def processShard(self, planFile, shard, numOfShards, shardOutput, workers=1):
+        '''
+            Processes the shard-th of numOfShards contiguous slices of the jobs of a plan (see planJobs, savePlan).
+            The rows of each job are stored in a JobManifest (shardOutput.manifest.json, shardOutput.parts),
+            so a shard can be resumed; mergeShards builds the output from all the shards.
+        '''
+        self.label = self.buildLabel()
+        jobs = self.loadPlan(planFile)
+        jobs = jobs[len(jobs) * shard // numOfShards:len(jobs) * (shard + 1) // numOfShards]
+
+        manifest = JobManifest.JobManifest(shardOutput + '.manifest.json', shardOutput + '.parts')
+        self.runManifestJobs(jobs, manifest, workers)
+
+    def mergeShards(self, planFile, shardOutputs, outputFile, outputFormat='csv'):
+        '''
+            Merges the outputs of the shards of a plan: the output is the same produced by a single node run
+            (all the jobs in plan order, continuous row numbering). The header is the one the shards were processed
+            with (recorded in their manifests), whatever the extraction parameters of self are.
+        '''
+        jobs = self.loadPlan(planFile)
+
+        manifests = [JobManifest.JobManifest(shardOutput + '.manifest.json', shardOutput + '.parts')
+                     for shardOutput in shardOutputs]
+        jobManifests = []
+        for job in jobs:
+            # the input files may not be available (or may have a different mtime) on the merging node:
+            # only the parts are checked
+            found = [manifest for manifest in manifests if manifest.isDone(job)]
+            if len(found) == 0:
+                raise ValueError("Error: job " + str(job) + " is missing in the shards.")
+            jobManifests.append(found[0])
+
+        extractions = [manifest.extraction(job) for job, manifest in zip(jobs, jobManifests)]
+        recorded = [extraction for extraction in extractions if extraction is not None]
+        if any(extraction != recorded[0] for extraction in recorded):
+            raise ValueError("Error: the jobs of the shards were processed with different extraction parameters.")
+        if len(recorded) > 0 and len(recorded) < len(extractions):
+            raise ValueError("Error: the extraction parameters of some jobs of the shards are not recorded.")
+        # shards of a previous version have no recorded extraction: the parameters of self are assumed
+        self.label = recorded[0]['label'] if len(recorded) > 0 else self.buildLabel()
+
+        self.finalizeOutput(jobs, jobManifests, outputFile, outputFormat)
+
+    def runJobs(self, jobs, workers=1):
+        '''
+            Yields, in job order, the features of each job as a sequence of blocks of rows.
+            The jobs are processed in groups (see groupJobs), with workers > 1 the groups are distributed over a pool
+            of processes.
+            With self.prefetch (and one worker) the next groups are read, i.e. the xml parsed and the wavs loaded,
+            by a reader thread while the features of the current one are computed.
+        '''
+        groups = self.groupJobs(jobs)
+
+        if workers <= 1:
+            items = pipelineIO.prefetch(self.readGroups(groups), self.prefetch) if self.prefetch > 0 else None
+            try:
+                for group in groups:
+                    groupItems = None if items is None else self.groupItems(items)
+                    if len(group) == 1:
+                        # blocks are written as soon as they are ready
+                        yield (block for i, block in self.processGroupBlocks(group, groupItems))
+                    else:
+                        for feature in self.processGroup(group, groupItems):
+                            yield [feature]
+            finally:
+                if items is not None:
+                    items.close()
+            return
+
+        pool = multiprocessing.Pool(workers)
+        try:
+            if Instrumentation.collector is None:
+                results = pool.imap(self.processGroup, groups)  # results are yielded in job order
+            else:
+                results = self.mergeRecords(pool.imap(self.processGroupRecorded, groups))
+            for feature in results:
+                for jobFeature in feature:
+                    yield [jobFeature]
+        except BaseException:
+            # a job failed, the run was interrupted or the caller stopped: the queued jobs are not run
+            pool.terminate()
+            pool.join()
+            raise
+        pool.close()
+        pool.join()
+
+    def openOutput(self, outputFile, outputFormat):
+        if outputFormat == 'columnar':
+            numOfMetadata = len(ColumnarDataset.ColumnarDataset.metadata)
+            return ColumnarDataset.ColumnarDataset(outputFile, self.label[:-numOfMetadata], dtype=self.outputDtype)
+
+        file = open(outputFile, 'ab')
+
+        header = ","
+        for x in self.label:
+            header += x + ","
+
+        file.write((header[:len(header)-1]+'\n').encode('ascii'))  # write .csv header
+        return file
+
+    def writeOutput(self, output, feature, numRow):
+        Instrumentation.count('rows', len(feature))
+        with Instrumentation.measure('write'):
+            if isinstance(output, ColumnarDataset.ColumnarDataset):
+                output.append(feature)
+            else:
+                self.writeToCSV(feature, numRow, len(self.label)+1, output)
+
+    def closeOutput(self, output):
+        if not isinstance(output, ColumnarDataset.ColumnarDataset):
+            output.close()
+
+    def processDataset(self, path, wavNum, snrRange, outputFile, workers=1, outputFormat='csv', resume=False):
+        '''
+            Process all the (wav, snr) jobs of the dataset. With workers > 1 the jobs are distributed over a pool of
+            processes; the results are collected in job order, so the output (rows and row numbering) is the same
+            produced by the serial run.
+            outputFormat is 'csv' (outputFile is a .csv file) or 'columnar' (outputFile is a ColumnarDataset
+            directory, the features are stored as self.outputDtype binary columns).
+            With resume the run can be interrupted and started again (see processJobsResumable).
+            With self.prefetch the reading of the next jobs and the writing of the output overlap with the
+            feature computation (see runJobs and writeJobs).
+        '''
+        self.label = self.buildLabel()
+        jobs = self.listJobs(path, wavNum, snrRange)
+
+        if resume:
+            self.processJobsResumable(jobs, outputFile, workers, outputFormat)
+            return
+
+        output = self.openOutput(outputFile, outputFormat)
+        cont = [0]
+
+        def write(job, feature):
+            if feature is not None:
+                self.writeOutput(output, feature, cont)
+
+        try:
+            self.writeJobs(jobs, workers, write)
+        finally:
+            self.closeOutput(output)
+
+    def writeJobs(self, jobs, workers, write, done=0, total=None):
+        '''
+            Runs the jobs (see runJobs) and calls write(job, rows) for each block of rows, in job order,
+            and write(job, None) after the last block of each job.
+            With self.prefetch the blocks are written by a writer thread while the next ones are computed.
+            With self.instrumentation the stages of the run are recorded (see Instrumentation).
+            done and total are the number of jobs already done and of all the jobs, for the progress bar.
+        '''
+        total = float(len(jobs) + done if total is None else total)
+
+        def blocks():
+            for count, (job, jobBlocks) in enumerate(zip(jobs, self.runJobs(jobs, workers)), done + 1):
+                for feature in jobBlocks:
+                    yield (job, feature)
+                yield (job, None)
+                Instrumentation.count('jobs')
+                self.update_progress(count / total)  # display progressbar
+
+        if self.instrumentation is not None:
+            self.instrumentation.start()
+        try:
+            if self.prefetch > 0:
+                pipelineIO.writeBehind(blocks(), lambda block: write(*block), self.prefetch)
+            else:
+                for job, feature in blocks():
+                    write(job, feature)
+        finally:
+            if self.instrumentation is not None:
+                self.instrumentation.stop()
+
+    def configure(self, config):
+        '''
+            Sets the parameters of a configuration (a dict), among:
+                - segmentation, the segment size (in seconds)
+                - overlap, the segment step (in seconds)
+                - tolerance, the fraction of a segment that can fall outside an event
+                - frameSize, frameStep, the short-term window size and step (in seconds)
+        '''
+        for name, value in config.items():
+            if name == 'segmentation':
+                self.segmentation = value
+                self.dataPre.frameSize = value
+            elif name in ('overlap', 'tolerance'):
+                setattr(self.dataPre, name, value)
+            elif name in ('frameSize', 'frameStep'):
+                setattr(self, name, value)
+            else:
+                raise ValueError("Error: unknown parameter " + str(name) + ", the parameters are "
+                                 "segmentation, overlap, tolerance, frameSize and frameStep.")
+
+    def processSweep(self, path, wavNum, snrRange, configs, outputFiles, outputFormat='csv'):
+        '''
+            Parameter sweep: processes the dataset once for each configuration of configs (see configure),
+            writing the output of the i-th configuration to outputFiles[i]. Every other parameter is the one of self.
+            Each wav is read once for all the configurations, and the configurations with the same short-term window
+            size and step share the spectra of their windows: each distinct window is transformed only once.
+            With segment normalization, the configurations with the same segment size also share the features of
+            their segments (e.g. the ones that differ only in tolerance): each distinct segment is processed only once.
+            The output of each configuration is the one of processDataset with sharedSpectra.
+            The memory used grows with the length of the recordings and the number of distinct windows.
+        '''
+        if len(configs) != len(outputFiles):
+            raise ValueError("Error: one output file is needed for each configuration.")
+
+        extractors = []
+        for config in configs:
+            fe = copy.deepcopy(self)
+            fe.cache = None
+            fe.configure(config)
+            fe.label = fe.buildLabel()
+            extractors.append(fe)
+
+        # the configurations with the same short-term windows share the spectra
+        groups = {}
+        for i, fe in enumerate(extractors):
+            groups.setdefault((fe.frameSize, fe.frameStep), []).append(i)
+
+        jobs = self.listJobs(path, wavNum, snrRange)
+        outputs = []
+        if self.instrumentation is not None:
+            self.instrumentation.start()
+        try:
+            for fe, outputFile in zip(extractors, outputFiles):
+                outputs.append(fe.openOutput(outputFile, outputFormat))
+            cont = [[0] for fe in extractors]
+
+            for done, (xml_path, wav_path, snr) in enumerate(jobs, 1):
+                [Fs, x] = audioBasicIO.readAudioFile(wav_path)
+                x = self.dataPre.channelSignal(x, wav_path)
+
+                for (frameSize, frameStep), indices in groups.items():
+                    Win = int(frameSize * Fs)
+                    Step = int(frameStep * Fs)
+                    tables = [extractors[i].dataPre.segmentSignal(xml_path, wav_path, x, Fs) for i in indices]
+
+                    spectra = None
+                    if audioFeatureExtraction.stNeedsSpectrum(self.selectedFeatures()):
+                        positions = [np.zeros(0, dtype=np.int64)]
+                        for table in tables:
+                            numOfFrames = (table.Win - Win) // Step + 1 if table.Win >= Win else 0
+                            positions.append((table.offsets[:, np.newaxis] + Step * np.arange(numOfFrames)).ravel())
+                        spectra = audioFeatureExtraction.stWindowSpectra(x, Win, np.unique(np.concatenate(positions)),
+                                                                         self.segmentNormalization, self.computeDtype)
+
+                    # without segment normalization the rounding of the features depends on the other segments
+                    # of their block, so the features are shared only with it (to keep the output exact)
+                    sharing = collections.OrderedDict()
+                    for i, table in zip(indices, tables):
+                        sharing.setdefault(table.Win if self.segmentNormalization else i, []).append((i, table))
+
+                    for segments in sharing.values():
+                        segWin = segments[0][1].Win
+                        offsets = np.unique(np.concatenate([table.offsets for i, table in segments]))
+                        with Instrumentation.measure('stFeatureExtraction'):
+                            stFeatures = audioFeatureExtraction.stFeatureExtractionSegments(
+                                x, Fs, Win, Step, offsets, segWin, segmentNormalization=self.segmentNormalization,
+                                features=self.selectedFeatures(), dtype=self.computeDtype, spectra=spectra)
+                        if stFeatures.ndim > 3:
+                            stFeatures = np.moveaxis(stFeatures, -3, 0)  # segments first
+
+                        for i, table in segments:
+                            fe = extractors[i]
+                            F = stFeatures[np.searchsorted(offsets, table.offsets)]
+                            fe.writeOutput(outputs[i], fe.buildRows(table, F, snr), cont[i])
+
+                Instrumentation.count('jobs')
+                self.update_progress(done / float(len(jobs)))  # display progressbar
+        finally:
+            for fe, output in zip(extractors, outputs):
+                fe.closeOutput(output)
+            if self.instrumentation is not None:
+                self.instrumentation.stop()
+
+    def processJobsResumable(self, jobs, outputFile, workers=1, outputFormat='csv'):
+        '''
+            Resumable run: the rows of each finished job are recorded in a JobManifest (outputFile.manifest.json,
+            outputFile.parts). A new run skips the jobs already done (same input files and parameters, valid part)
+            and processes only the missing or changed ones; then the output is written from scratch, in job order
+            and with continuous row numbering, and atomically replaces outputFile.
+        '''
+        manifest = JobManifest.JobManifest(outputFile + '.manifest.json', outputFile + '.parts')
+        self.runManifestJobs(jobs, manifest, workers)
+        self.finalizeOutput(jobs, [manifest] * len(jobs), outputFile, outputFormat)
+
+    def runManifestJobs(self, jobs, manifest, workers=1):
+        '''
+            Processes the jobs that are not done in manifest, recording each of them when it is finished
+        '''
+        if len(jobs) == 0:
+            return
+
+        parameters = self.cacheParameters()
+        fingerprints = [manifest.fingerprint(job, dict(parameters, snr=job[2])) for job in jobs]
+        todo = [(job, fingerprint) for job, fingerprint in zip(jobs, fingerprints)
+                if not manifest.isDone(job, fingerprint)]
+
+        done = len(jobs) - len(todo)
+        self.update_progress(done / float(len(jobs)))
+        if len(todo) == 0:
+            return
+
+        # the rows of a job are appended to its part block by block, and the job is recorded after its last block
+        fingerprints = dict(todo)
+        extraction = {'label': self.label, 'parameters': parameters}
+
+        def write(job, feature):
+            if feature is None:
+                manifest.markDone(job, fingerprints[job], extraction=extraction)
+            else:
+                manifest.appendPart(job, feature)
+
+        self.writeJobs([job for job, fingerprint in todo], workers, write, done=done, total=len(jobs))
+
+    def finalizeOutput(self, jobs, manifests, outputFile, outputFormat):
+        '''
+            Writes the rows of the jobs (stored in manifests, one for each job) to outputFile, atomically
+        '''
+        tmpFile = outputFile + '.tmp'
+        if os.path.isdir(tmpFile):
+            shutil.rmtree(tmpFile)
+        elif os.path.exists(tmpFile):
+            os.remove(tmpFile)
+
+        output = self.openOutput(tmpFile, outputFormat)
+        cont = [0]
+        try:
+            try:
+                for job, manifest in zip(jobs, manifests):
+                    manifest.setRowRange(job, cont[0])
+                    for feature in manifest.readPart(job):
+                        self.writeOutput(output, feature, cont)
+                    cont[0] = manifest.jobs[manifest.jobKey(job)]['lastRow']
+            finally:
+                self.closeOutput(output)
+        except BaseException:
+            # no partial output is left behind
+            if os.path.isdir(tmpFile):
+                shutil.rmtree(tmpFile)
+            elif os.path.exists(tmpFile):
+                os.remove(tmpFile)
+            raise
+
+        if os.path.isdir(tmpFile):
+            # a directory can not be replaced atomically: keep the old one until the new one is in place
+            if os.path.exists(outputFile):
+                os.rename(outputFile, outputFile + '.old')
+            os.rename(tmpFile, outputFile)
+            if os.path.exists(outputFile + '.old'):
+                shutil.rmtree(outputFile + '.old')
+        else:
+            os.replace(tmpFile, outputFile)
+        for manifest in set(manifests):
+            manifest.save()
+
+def main(argv=None):
+    '''
+        Command line interface, e.g. the training and testing datasets:
+
+            python FeatureExtraction.py extract MIVIA_DB4_dist/training/ --wav-num 67 --snr-range 6 \\
+                --output out/validation3_training_dataset0300_overlap.csv
+            python FeatureExtraction.py extract MIVIA_DB4_dist/testing/ --wav-num 30 --snr-range 6 \\
+                --output out/validation3_testing_dataset0300_overlap.csv
+
+        and the plan, shard and merge steps of a distributed run (see planJobs, processShard, mergeShards).
+    '''
+    parser = argparse.ArgumentParser(description='Feature extraction on the Mivia Audio Events Dataset.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
 
-                self.writeToCSV(feature, cont, len(self.label)+1, file)
+    options = argparse.ArgumentParser(add_help=False)  # extraction options, shared by the commands
+    options.add_argument('--features', help='comma separated features to extract (default: all)')
+    options.add_argument('--aggregation', choices=sorted(aggregations), default='median')
+    options.add_argument('--dtype', choices=['float64', 'float32'], default='float64', help='computation precision')
+    options.add_argument('--shared-spectra', action='store_true', help='short-term analysis once per recording')
+    options.add_argument('--stack-snr', action='store_true', help='process the snr variants of a recording at once')
+    options.add_argument('--channels', type=int, default=1, help='channels of the recordings (1: downmix to mono)')
+    options.add_argument('--block-duration', type=float,
+                         help='process the recordings in blocks of these seconds (bounded memory, but with --stack-snr '
+                              'or --workers > 1 the rows of a job are held until it ends)')
+    options.add_argument('--prefetch', type=int, default=2, help='items read ahead and written behind (0: no threads)')
+    options.add_argument('--cache', help='directory of the feature cache')
+    options.add_argument('--stats', help='json file of the per-stage timing summary (see Instrumentation)')
 
-                progress = float(((i - 1) * (snrRange) + j) / total)
-                self.update_progress(progress)  # display progressbar
+    extract = commands.add_parser('extract', parents=[options], help='extract the features of a dataset')
+    extract.add_argument('path', help='dataset directory (xml files, wavs in sounds/)')
+    extract.add_argument('--wav-num', type=int, required=True, help='recordings 1 .. wav-num - 1 are processed')
+    extract.add_argument('--snr-range', type=int, default=6, help='snr variants 1 .. snr-range are processed')
+    extract.add_argument('--output', required=True, help='output .csv file (or columnar directory)')
+    extract.add_argument('--format', choices=['csv', 'columnar'], default='csv')
+    extract.add_argument('--workers', type=int, default=1, help='number of worker processes')
+    extract.add_argument('--resume', action='store_true', help='resumable run (see processJobsResumable)')
 
-# #############################################################
-# ############IN ORDER TO CREATE TRAINING DATASET##############
-# #############################################################
+    plan = commands.add_parser('plan', help='list the jobs of a dataset in a plan file')
+    plan.add_argument('path', help='dataset directory (xml files, wavs in sounds/)')
+    plan.add_argument('--snr-range', type=int, help='snr variants 1 .. snr-range are planned (default: all)')
+    plan.add_argument('--output', required=True, help='plan (json) file')
 
-print("Pocessing training dataset...")
-print("")
-start_time = time.time()
+    shard = commands.add_parser('shard', parents=[options], help='process a shard of the jobs of a plan')
+    shard.add_argument('plan', help='plan (json) file')
+    shard.add_argument('--shard', type=int, required=True, help='index of the shard (from 0)')
+    shard.add_argument('--shards', type=int, required=True, help='number of shards')
+    shard.add_argument('--output', required=True, help='shard output (manifest and parts prefix)')
+    shard.add_argument('--workers', type=int, default=1, help='number of worker processes')
 
-fe = FeatureExtraction()
-fe.processDataset(path='/home/valerio/Scrivania/stage/dataset/MIVIA_DB4_dist/training/',
-                       wavNum=67, snrRange=6,
-                       outputFile='out/validation3_training_dataset0300_overlap.csv')
+    merge = commands.add_parser('merge', parents=[options],
+                                help='merge the shards of a plan (with the header the shards were processed with)')
+    merge.add_argument('plan', help='plan (json) file')
+    merge.add_argument('shards', nargs='+', help='shard outputs')
+    merge.add_argument('--output', required=True, help='output .csv file (or columnar directory)')
+    merge.add_argument('--format', choices=['csv', 'columnar'], default='csv')
 
-elapsed_time = time.time()-start_time
-print("")
-print("Elapsed time: " + str(elapsed_time))
+    args = parser.parse_args(argv)
 
-# #############################################################
-# #############################################################
-# #############################################################
+    fe = FeatureExtraction()
+    if args.command == 'plan':
+        fe.savePlan(fe.planJobs(args.path, args.snr_range), args.output)
+        return
 
+    if args.features is not None:
+        fe.selectFeatures(args.features.split(','))
+    fe.aggregation = args.aggregation
+    fe.setChannels(args.channels)
+    fe.computeDtype = args.dtype
+    fe.sharedSpectra = args.shared_spectra
+    fe.stackSnr = args.stack_snr
+    fe.blockDuration = args.block_duration
+    fe.prefetch = args.prefetch
+    if args.cache is not None:
+        fe.cache = FeatureCache.FeatureCache(args.cache)
+    if args.stats is not None:
+        fe.instrumentation = Instrumentation.Instrumentation()
 
-#############################################################
-############IN ORDER TO CREATE TESTING DATASET##############
-#############################################################
+    start_time = time.time()
+    if args.command == 'extract':
+        fe.processDataset(args.path, args.wav_num, args.snr_range, args.output, workers=args.workers,
+                          outputFormat=args.format, resume=args.resume)
+    elif args.command == 'shard':
+        fe.processShard(args.plan, args.shard, args.shards, args.output, workers=args.workers)
+    else:
+        fe.mergeShards(args.plan, args.shards, args.output, outputFormat=args.format)
 
-# print("Pocessing testing dataset...")
-# print("")
-# start_time = time.time()
-#
-# fe = FeatureExtraction()
-# fe.processDataset(path='/home/valerio/Scrivania/stage/dataset/MIVIA_DB4_dist/testing/',
-#                        wavNum=30, snrRange=6,
-#                        outputFile='out/validation3_testing_dataset0300_overlap.csv')
-#
-# elapsed_time = time.time()-start_time
-# print("")
-# print("Elapsed time: " + str(elapsed_time))
+    print("")
+    print("Elapsed time: " + str(time.time() - start_time))
+    if args.stats is not None:
+        fe.instrumentation.save(args.stats)
 
 
-#############################################################
-#############################################################
-#############################################################
\ No newline at end of file
+if __name__ == '__main__':
+    main()
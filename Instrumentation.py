@@ -0,0 +1,213 @@
+import json
+import math
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows: the peak RSS is not reported
+    resource = None
+
+collector = None  # the active Instrumentation, the hooks do nothing when it is None
+
+
+def measure(name):
+    '''
+    This function is the hook around a stage of the extraction:
+
+        with Instrumentation.measure('decode') as stage:
+            x = ...
+            stage.allocated(x.nbytes)
+
+    The time of the stage is recorded by the active Instrumentation; without one it only costs a function call.
+    '''
+    if collector is None:
+        return _idle
+    return _Stage(collector, name)
+
+
+def count(name, n=1):
+    '''
+    This function adds n to the counter name of the active Instrumentation (e.g. the number of segments)
+    '''
+    if collector is not None:
+        collector.add(name, n)
+
+
+def peakRSS():
+    '''
+    This function returns the peak resident memory of the process in MB (None if it is not available)
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0  # bytes on macOS, else KB
+
+
+class _Stage:
+    __slots__ = ('instrumentation', 'name', 'start', 'bytes')
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.bytes = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self.instrumentation.record(self.name, time.perf_counter() - self.start, self.bytes)
+        return False
+
+    def allocated(self, nbytes):
+        self.bytes += nbytes
+
+
+class _IdleStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+    def allocated(self, nbytes):
+        pass
+
+
+_idle = _IdleStage()
+
+
+class Instrumentation:
+    '''
+        Collects where the time of the feature extraction goes: the hooks of the extraction code (see measure and count)
+        record every call of each stage while the Instrumentation is started.
+
+            decode                   reading (decoding) of a wav file or block, bytes of the samples
+            load                     loading of a memory mapped wav in memory (reader thread), bytes of the samples
+            xmlParse                 parsing of an xml file
+            segmentation             labeling of the segments of a recording (xml parsing included)
+            stFeatureExtraction      short-term analysis of a segment, or of a block of segments with sharedSpectra
+            fft                      spectra of the short-term windows, bytes of the spectra
+            feature.<function>       each feature function (e.g. feature.stMFCCBatch, feature.stSpectralFlux)
+            aggregation              statistics of the short-term features, bytes of the aggregated values
+            write                    writing of a block of rows in the output
+
+        The times of the nested stages are included in the enclosing ones. For each stage it keeps the number of
+        calls, the total, minimum and maximum time, the bytes allocated for its results and a histogram of the call
+        times ([upper bound in seconds, calls], power of two microseconds buckets); the counters count the segments,
+        rows and jobs.
+        The summary (see summary and save) is a json document, with the segments per second over the time the
+        Instrumentation was started and the peak RSS of the process.
+        The stages can run in the reader and writer threads, the calls are recorded under a lock; with a pool of
+        processes the records of the workers are merged (see merge).
+    '''
+
+    def __init__(self):
+        self.stages = {}  # name: [calls, total, minimum, maximum, bytes, {bucket: calls}]
+        self.counters = {}
+        self.elapsed = 0.0
+        self.lock = threading.Lock()
+        self.depth = 0
+        self.previous = None
+        self.started = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()  # copied or pickled (e.g. with a FeatureExtraction) without the lock
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def start(self):
+        '''
+            Makes this Instrumentation the active one (the starts and stops can be nested)
+        '''
+        global collector
+        self.depth += 1
+        if self.depth == 1:
+            self.previous = collector
+            collector = self
+            self.started = time.perf_counter()
+
+    def stop(self):
+        global collector
+        self.depth -= 1
+        if self.depth == 0:
+            self.elapsed += time.perf_counter() - self.started
+            collector = self.previous
+            self.previous = None
+
+    def record(self, name, seconds, nbytes=0):
+        bucket = math.frexp(seconds * 1e6)[1]  # upper bound 2 ** bucket microseconds
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = [0, 0.0, seconds, seconds, 0, {}]
+            stage[0] += 1
+            stage[1] += seconds
+            stage[2] = min(stage[2], seconds)
+            stage[3] = max(stage[3], seconds)
+            stage[4] += nbytes
+            stage[5][bucket] = stage[5].get(bucket, 0) + 1
+
+    def add(self, name, n):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def records(self):
+        '''
+            The records of the stages and the counters (e.g. to be merged by another process, see merge)
+        '''
+        with self.lock:
+            stages = dict((name, stage[:5] + [dict(stage[5])]) for name, stage in self.stages.items())
+            return {'stages': stages, 'counters': dict(self.counters)}
+
+    def merge(self, records):
+        with self.lock:
+            for name, other in records['stages'].items():
+                stage = self.stages.get(name)
+                if stage is None:
+                    self.stages[name] = other[:5] + [dict(other[5])]
+                    continue
+                stage[0] += other[0]
+                stage[1] += other[1]
+                stage[2] = min(stage[2], other[2])
+                stage[3] = max(stage[3], other[3])
+                stage[4] += other[4]
+                for bucket, calls in other[5].items():
+                    stage[5][bucket] = stage[5].get(bucket, 0) + calls
+            for name, n in records['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        '''
+            The json serializable summary of the records
+        '''
+        elapsed = self.elapsed
+        if self.depth > 0:
+            elapsed += time.perf_counter() - self.started
+
+        records = self.records()
+        stages = {}
+        for name, (calls, total, minimum, maximum, nbytes, histogram) in records['stages'].items():
+            stages[name] = {'calls': calls, 'seconds': total, 'mean': total / calls, 'min': minimum, 'max': maximum,
+                            'bytes': nbytes,
+                            'histogram': [[2.0 ** bucket * 1e-6, histogram[bucket]] for bucket in sorted(histogram)]}
+
+        segments = records['counters'].get('segments', 0)
+        return {'elapsed': elapsed, 'counters': records['counters'],
+                'segmentsPerSecond': segments / elapsed if elapsed > 0 else None,
+                'stages': stages, 'peakRSS': peakRSS()}
+
+    def save(self, filename):
+        '''
+            Writes the summary in a json file
+        '''
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=1, sort_keys=True)
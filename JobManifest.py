@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import pickle
+
+
+class JobManifest:
+    '''
+        Records the (xml, wav, snr) jobs of a dataset run that are finished, so an interrupted run can be resumed.
+
+        The rows of each finished job are stored in a part file (in partsPath), a block of rows at a time (see
+        appendPart and readPart), so a job is never held in memory as a whole; the manifest (a json file, replaced
+        atomically after each job) stores for each job its part file, the number of rows, the checksum of the part file
+        and the fingerprint of its inputs (size and modification time of the wav and xml files, extraction parameters).
+        A job is done only if its fingerprint did not change and its part file matches the checksum.
+        Each job also records the extraction it was processed with (the .csv header and the parameters, stored once
+        in the manifest for all the jobs that share it), so the outputs of other nodes can be merged (see extraction).
+        When the output is finalized the manifest also records the range of rows of each job.
+    '''
+
+    version = 1  # part of every fingerprint: increase it when the extraction code changes its results
+
+    def __init__(self, manifestPath, partsPath):
+        self.manifestPath = manifestPath
+        self.partsPath = partsPath
+        self.jobs = {}
+        self.extractions = {}  # id: the extraction of some jobs (see markDone)
+        self.pending = {}  # job key: rows appended to the part of a job not yet done
+
+        if not os.path.isdir(partsPath):
+            os.makedirs(partsPath)
+        if os.path.exists(manifestPath):
+            with open(manifestPath) as f:
+                manifest = json.load(f)
+            self.jobs = manifest['jobs']
+            self.extractions = manifest.get('extractions', {})
+
+    def jobKey(self, job):
+        xml_path, wav_path, snr = job
+        return wav_path + '|' + xml_path + '|' + str(snr)
+
+    def fingerprint(self, job, parameters):
+        xml_path, wav_path, snr = job
+        files = []
+        for filename in (wav_path, xml_path):
+            st = os.stat(filename)
+            files.append([filename, st.st_size, st.st_mtime])
+        h = hashlib.sha256(json.dumps({'version': self.version, 'files': files, 'parameters': parameters},
+                                      sort_keys=True).encode('utf-8'))
+        return h.hexdigest()
+
+    def checksum(self, filename):
+        h = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    def partPath(self, job):
+        return os.path.join(self.partsPath, hashlib.sha1(self.jobKey(job).encode('utf-8')).hexdigest() + '.pkl')
+
+    def isDone(self, job, fingerprint=None):
+        '''
+            True if the job is finished and its part is valid (and its fingerprint matches, if given)
+        '''
+        entry = self.jobs.get(self.jobKey(job))
+        if entry is None or (fingerprint is not None and entry['fingerprint'] != fingerprint):
+            return False
+        try:
+            return self.checksum(self.partPath(job)) == entry['checksum']
+        except (IOError, OSError):
+            return False
+
+    def appendPart(self, job, feature):
+        '''
+            Appends a block of rows to the part of a job, the part is complete when the job is marked done
+        '''
+        key = self.jobKey(job)
+        with open(self.partPath(job) + '.tmp', 'ab' if key in self.pending else 'wb') as f:
+            pickle.dump(feature, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.pending[key] = self.pending.get(key, 0) + len(feature)
+
+    def markDone(self, job, fingerprint, extraction=None):
+        '''
+            Records a job as done, with the blocks appended to its part, and the extraction it was processed with
+            (a json serializable dict, e.g. the header and the parameters)
+        '''
+        if self.jobKey(job) not in self.pending:
+            self.appendPart(job, [])  # a job without rows still has a part
+        partPath = self.partPath(job)
+        os.replace(partPath + '.tmp', partPath)
+
+        entry = {'fingerprint': fingerprint, 'rows': self.pending.pop(self.jobKey(job)),
+                 'checksum': self.checksum(partPath)}
+        if extraction is not None:
+            entry['extraction'] = hashlib.sha1(json.dumps(extraction, sort_keys=True).encode('utf-8')).hexdigest()
+            self.extractions[entry['extraction']] = extraction
+        self.jobs[self.jobKey(job)] = entry
+        self.save()
+
+    def extraction(self, job):
+        '''
+            The extraction a done job was processed with, None if it was not recorded
+        '''
+        entry = self.jobs[self.jobKey(job)]
+        return self.extractions.get(entry['extraction']) if 'extraction' in entry else None
+
+    def readPart(self, job):
+        '''
+            Yields the blocks of rows of the part of a job
+        '''
+        with open(self.partPath(job), 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+    def setRowRange(self, job, firstRow):
+        entry = self.jobs[self.jobKey(job)]
+        entry['firstRow'] = firstRow
+        entry['lastRow'] = firstRow + entry['rows']  # excluded
+
+    def save(self):
+        with open(self.manifestPath + '.tmp', 'w') as f:
+            json.dump({'jobs': self.jobs, 'extractions': self.extractions}, f, indent=1, sort_keys=True)
+        os.replace(self.manifestPath + '.tmp', self.manifestPath)
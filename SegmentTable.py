@@ -0,0 +1,74 @@
+import numpy as np
+
+import Event
+
+
+class SegmentTable:
+    '''
+           Compact, column oriented storage of the segments of a signal.
+           Each segment is stored as a sample offset into the source signal (no copy of the data), an int8 target
+           and the codes of its id and background (dictionary encoded). Segment data are materialized lazily as views.
+    '''
+
+    __slots__ = ('signal', 'Fs', 'Win', 'offsets', 'targets', 'idCodes', 'ids', 'backgroundCodes', 'backgrounds',
+                 'origin', 'normalization')
+
+    def __init__(self, signal, Fs, Win, offsets, targets, idCodes, ids, backgroundCodes, backgrounds, origin=0,
+                 normalization=None):
+        self.signal = signal
+        self.origin = origin  # position of signal in the recording (in samples), for tables of a block of it
+        self.normalization = normalization  # (DC, MAX) of the whole recording, for tables of a block of it
+        self.Fs = Fs
+        self.Win = int(Win)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.targets = np.asarray(targets, dtype=np.int8)
+        self.idCodes = np.asarray(idCodes, dtype=np.int32)
+        self.ids = list(ids)
+        self.backgroundCodes = np.asarray(backgroundCodes, dtype=np.int32)
+        self.backgrounds = list(backgrounds)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        return self.getEvent(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.getEvent(i)
+
+    def getData(self, i):
+        offset = self.offsets[i]
+        return self.signal[..., offset:offset + self.Win]
+
+    def getId(self, i):
+        return self.ids[self.idCodes[i]]
+
+    def getTarget(self, i):
+        return str(self.targets[i])
+
+    def getBackground(self, i):
+        return self.backgrounds[self.backgroundCodes[i]]
+
+    def getStartSecond(self, i):
+        return (self.origin + self.offsets[i]) / float(self.Fs)
+
+    def getStopSecond(self, i):
+        return (self.origin + self.offsets[i] + self.Win) / float(self.Fs)
+
+    def select(self, c, ids=None):
+        '''
+            The table of the c-th signal of a table of stacked signals (numOfSignals x numOfSamples), with the same
+            segments; ids (if given) replaces the dictionary of the ids
+        '''
+        normalization = None if self.normalization is None else (self.normalization[0][c], self.normalization[1][c])
+        return SegmentTable(self.signal[c], self.Fs, self.Win, self.offsets, self.targets, self.idCodes,
+                            self.ids if ids is None else ids, self.backgroundCodes, self.backgrounds, self.origin,
+                            normalization)
+
+    def getEvent(self, i):
+        '''
+            Materializes the i-th segment as an Event (its data is a view of the signal)
+        '''
+        return Event.Event(self.getId(i), self.getTarget(i), self.getStartSecond(i), self.getStopSecond(i),
+                           self.getBackground(i), self.getData(i))
@@ -0,0 +1,117 @@
+import numpy as np
+
+import FeatureExtraction
+import audioFeatureExtraction
+
+
+class StreamingFeatureExtraction:
+    '''
+        Online feature extraction for live audio (e.g. a microphone feed).
+
+        PCM chunks of any size are pushed with process(). A ring buffer keeps the last 300ms of signal and,
+        every 150ms, the feature vector of the last 300ms segment is emitted: the same 42 values that
+        FeatureExtraction.extractFeatures computes on that segment.
+
+                       |---------------------300ms--------------------|
+                                               |---------------------300ms--------------------|
+
+                       |---------150ms---------|
+                                   |---------150ms---------|
+                                              |---------150ms---------|     <- shared by the two segments
+                                                           |---------150ms---------|
+                                                                      |---------150ms---------|
+
+        The spectra of the 150ms frames are cached until the last segment using them has been emitted, so each hop
+        only transforms the frames it adds (the segment normalization is applied to the cached spectra,
+        see audioFeatureExtraction.stFeaturesFromRawFrames).
+    '''
+
+    def __init__(self, Fs, fe=None):
+        if fe is None:
+            fe = FeatureExtraction.FeatureExtraction()
+
+        self.Fs = Fs
+        self.features = fe.selectedFeatures()
+        self.needsSpectrum = audioFeatureExtraction.stNeedsSpectrum(self.features)
+        self.aggregation = fe.aggregation
+        self.dtype = np.dtype(fe.computeDtype)
+        self.Win = int(Fs * fe.dataPre.frameSize)  # segment size
+        self.Step = int(Fs * fe.dataPre.overlap)  # segment step
+        self.frameWin = int(fe.frameSize * Fs)
+        self.frameStep = int(fe.frameStep * Fs)
+        self.nFFT = int(self.frameWin / 2)
+        self.numOfFrames = (self.Win - self.frameWin) // self.frameStep + 1
+        self.numOfColumns = len(self.features) * len(FeatureExtraction.aggregations[self.aggregation][1])
+        self.reset()
+
+    def reset(self):
+        self.buffer = np.zeros(self.Win, dtype=self.dtype)  # ring buffer of the last Win samples
+        self.received = 0  # number of samples received
+        self.nextStart = 0  # first sample of the next segment
+        self.spectra = {}  # first sample of a frame: fft of the frame
+
+    def process(self, chunk):
+        '''
+            Pushes a chunk of PCM samples (a numpy array, or bytes of 16 bit little-endian samples) of a mono stream,
+            a (numOfSamples x 1) array is accepted too.
+            It returns the feature vectors of the segments completed by the chunk (numOfSegments x 42),
+            the segment k starts at sample k * Step of the stream.
+        '''
+        if isinstance(chunk, (bytes, bytearray)):
+            chunk = np.frombuffer(chunk, dtype='<i2')
+        chunk = np.asarray(chunk, dtype=self.dtype)
+        if chunk.ndim == 2 and chunk.shape[1] == 1:
+            chunk = chunk.reshape(-1)
+        if chunk.ndim != 1:
+            raise ValueError("Error: the chunk has shape " + str(chunk.shape) + ", the stream is mono: the channels "
+                             "must be downmixed first (see DatasetPreprocessing.channelSignal).")
+        chunk = chunk / (2.0 ** 15)
+
+        feature = []
+        pos = 0
+        while pos < len(chunk):
+            # never write past the end of the next segment, its first samples would be overwritten
+            n = min(len(chunk) - pos, self.nextStart + self.Win - self.received)
+            self.write(chunk[pos:pos + n])
+            pos += n
+
+            if self.received == self.nextStart + self.Win:
+                feature.append(self.emit())
+
+        if len(feature) == 0:
+            return np.zeros((0, self.numOfColumns), dtype=self.dtype)
+        return np.array(feature)
+
+    def write(self, x):
+        index = (self.received + np.arange(len(x))) % self.Win
+        self.buffer[index] = x
+        self.received += len(x)
+
+    def emit(self):
+        k = self.received % self.Win
+        segment = np.concatenate((self.buffer[k:], self.buffer[:k]))  # the last Win samples, in order
+
+        frames = []
+        spectra = []
+        for j in range(self.numOfFrames):
+            offset = j * self.frameStep
+            position = self.nextStart + offset
+            frame = segment[offset:offset + self.frameWin]
+            if self.needsSpectrum and position not in self.spectra:
+                self.spectra[position] = audioFeatureExtraction.stSpectrum(frame, self.nFFT)
+            frames.append(frame)
+            spectra.append(self.spectra.get(position))
+
+        # per-segment DC and peak, as computed by stFeatureExtraction on the segment
+        DC = segment.mean()
+        MAX = np.abs(segment).max()
+        spectra = np.array([spectra]) if self.needsSpectrum else None
+        F = audioFeatureExtraction.stFeaturesFromRawFrames(np.array([frames]), spectra, [DC], [MAX], self.Fs,
+                                                           self.features)
+
+        self.nextStart += self.Step
+        for position in [p for p in self.spectra if p < self.nextStart]:
+            del self.spectra[position]  # no later segment uses this frame
+
+        function = FeatureExtraction.aggregations[self.aggregation][0]
+        return function(F).reshape(-1)
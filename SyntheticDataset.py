@@ -0,0 +1,126 @@
+import os
+import wave
+
+import numpy as np
+
+
+class SyntheticDataset:
+    '''
+        Generates a synthetic dataset with the layout of the Mivia Audio Events Dataset, to run the feature extraction
+        (e.g. the benchmarks, see Benchmark) without the licensed dataset:
+
+            path/00001.xml                  events of the recording (see DatasetPreprocessing.parseXml)
+            path/sounds/00001_1.wav         the recording at snr 30dB
+            ...
+            path/sounds/00001_6.wav         the recording at snr 5dB
+
+        The recordings are 16 bit mono wavs: a background noise with glass breaking, gun shot and scream like events
+        at random times, mixed at each snr. The dataset depends only on the parameters (and seed).
+    '''
+
+    classNames = ['glass', 'gunshots', 'screams']
+    backgroundNames = ['crowd', 'rain', 'traffic', 'wind']
+
+    def __init__(self):
+        self.duration = 60.0  # seconds of each recording
+        self.Fs = 32000
+        self.eventDensity = 6.0  # events per minute
+        self.snrCount = 6  # snr variants of each recording: 30dB, 25dB, ... (5dB steps)
+        self.seed = 0
+
+    def snrLevels(self):
+        return [30 - 5 * j for j in range(self.snrCount)]
+
+    def generate(self, path, numOfRecordings):
+        '''
+            Writes numOfRecordings recordings (xml + snr variants) in path and returns the (xml, wav, snr) jobs,
+            in the order of FeatureExtraction.listJobs(path, numOfRecordings + 1, self.snrCount)
+        '''
+        soundsPath = os.path.join(path, 'sounds')
+        if not os.path.isdir(soundsPath):
+            os.makedirs(soundsPath)
+
+        jobs = []
+        for i in range(1, numOfRecordings + 1):
+            rng = np.random.RandomState(self.seed * 100003 + i)
+            events = self.placeEvents(rng)
+            background = [self.backgroundNames[k] for k in sorted(rng.choice(len(self.backgroundNames), 2, False))]
+
+            xml_path = os.path.join(path, '%05d.xml' % i)
+            self.writeXml(xml_path, events, background)
+
+            [noise, foreground] = self.synthesize(rng, events)
+            for j, snr in enumerate(self.snrLevels()):
+                wav_path = os.path.join(soundsPath, '%05d_%d.wav' % (i, j + 1))
+                self.writeWav(wav_path, self.mix(noise, foreground, snr))
+                jobs.append((xml_path, wav_path, j + 1))
+
+        return jobs
+
+    def placeEvents(self, rng):
+        '''
+            Random, non overlapping events (className, startSecond, stopSecond), eventDensity per minute on average
+        '''
+        numOfEvents = rng.poisson(self.eventDensity * self.duration / 60.0)
+        events = []
+        for k in range(numOfEvents):
+            length = rng.uniform(0.3, 2.5)
+            start = rng.uniform(0.5, max(self.duration - length - 0.5, 0.5))
+            if all(start > stop + 0.5 or start + length + 0.5 < other for name, other, stop in events):
+                events.append((self.classNames[rng.randint(len(self.classNames))], start, start + length))
+
+        return sorted(events, key=lambda event: event[1])
+
+    def writeXml(self, xml_path, events, background):
+        items = ''.join('<item><SUBCLASS>%s</SUBCLASS></item>' % name for name in background)
+        xml = ['<?xml version="1.0" encoding="utf-8"?>', '<root>', '<background>' + items + '</background>', '<events>']
+        for k, (className, start, stop) in enumerate(events):
+            xml.append('<item><CLASS_ID>%d</CLASS_ID><CLASS_NAME>%s_%05d.wav</CLASS_NAME>'
+                       '<STARTSECOND>%.6f</STARTSECOND><ENDSECOND>%.6f</ENDSECOND></item>'
+                       % (self.classNames.index(className) + 2, className, k + 1, start, stop))
+        xml.extend(['</events>', '</root>'])
+
+        with open(xml_path, 'w') as f:
+            f.write('\n'.join(xml) + '\n')
+
+    def synthesize(self, rng, events):
+        '''
+            The background noise (unit power, low-pass filtered) and the events of a recording (foreground)
+        '''
+        N = int(self.duration * self.Fs)
+        noise = np.convolve(rng.standard_normal(N), np.ones(4) / 2.0, mode='same')
+
+        foreground = np.zeros(N)
+        for className, start, stop in events:
+            a = int(start * self.Fs)
+            b = min(int(stop * self.Fs), N)
+            t = np.arange(b - a) / float(self.Fs)
+            if className == 'glass':  # inharmonic high partials, fast decay
+                partials = rng.uniform(2000, min(12000, self.Fs / 2.5), 5)
+                event = np.sin(2 * np.pi * partials[:, np.newaxis] * t).sum(axis=0) * np.exp(-t * 6)
+            elif className == 'gunshots':  # impulsive noise burst
+                event = rng.standard_normal(len(t)) * np.exp(-t * 12)
+            else:  # harmonic tone with vibrato
+                f0 = rng.uniform(400, 900) * (1 + 0.03 * np.sin(2 * np.pi * 5 * t))
+                phase = 2 * np.pi * np.cumsum(f0) / self.Fs
+                event = sum(np.sin(h * phase) / h for h in range(1, 5))
+            foreground[a:b] += event / np.sqrt(np.mean(event ** 2))  # unit power
+
+        return noise, foreground
+
+    def mix(self, noise, foreground, snr):
+        '''
+            The 16 bit samples of the events mixed with the background noise at snr (dB, event to noise power)
+        '''
+        x = noise + foreground * 10 ** (snr / 20.0)
+        return np.clip(np.round(x * (16000.0 / np.max(np.abs(x)))), -32768, 32767).astype('<i2')
+
+    def writeWav(self, wav_path, x):
+        f = wave.open(wav_path, 'wb')
+        try:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(self.Fs)
+            f.writeframes(x.tobytes())
+        finally:
+            f.close()
@@ -1,37 +1,166 @@
+import struct
+
 import numpy
-from pydub import AudioSegment
 
-import sys
+import Instrumentation
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def readWavHeader(path):
+    '''
+    This function parses the RIFF header of a PCM WAV file (16 or 32 bit).
+    It returns (Fs, channels, dtype, dataOffset, numOfFrames), or None if the file is not a WAV file it can handle.
+    '''
+    with open(path, 'rb') as f:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[0:4] != b'RIFF' or riff[8:12] != b'WAVE':
+            return None
+
+        fmt = None
+        while True:
+            chunkHeader = f.read(8)
+            if len(chunkHeader) < 8:
+                return None  # no data chunk
+            chunkId, chunkSize = struct.unpack('<4sI', chunkHeader)
+            if chunkId == b'fmt ':
+                fmt = f.read(chunkSize)
+                if len(fmt) < 16:
+                    return None
+                f.seek(chunkSize % 2, 1)  # chunks are word aligned
+            elif chunkId == b'data':
+                dataOffset = f.tell()
+                break
+            else:
+                f.seek(chunkSize + chunkSize % 2, 1)
+
+        f.seek(0, 2)
+        fileSize = f.tell()
+
+    if fmt is None:
+        return None
+    audioFormat, channels, Fs, byteRate, blockAlign, bitsPerSample = struct.unpack('<HHIIHH', fmt[:16])
+    if audioFormat == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+        audioFormat = struct.unpack('<H', fmt[24:26])[0]  # first two bytes of the sub-format GUID
+    if audioFormat != WAVE_FORMAT_PCM or channels < 1:
+        return None
+
+    if bitsPerSample == 16:
+        dtype = numpy.dtype('<i2')
+    elif bitsPerSample == 32:
+        dtype = numpy.dtype('<i4')
+    else:
+        return None
+    if blockAlign != dtype.itemsize * channels:
+        return None
+
+    # the declared size can be wrong (e.g. streamed files), never read past the end of the file
+    dataSize = min(chunkSize, fileSize - dataOffset)
+    numOfFrames = dataSize // blockAlign
+
+    return (Fs, channels, dtype, dataOffset, numOfFrames)
+
+
+def readWavFile(path):
+    '''
+    This function returns a read-only numpy.memmap view of the samples of a PCM WAV file (16 or 32 bit),
+    the RIFF header is parsed directly and no sample is decoded or copied.
+    It returns (-1, -1) if the file is not a WAV file it can handle.
+    '''
+    header = readWavHeader(path)
+    if header is None:
+        return (-1, -1)
+    [Fs, channels, dtype, dataOffset, numOfFrames] = header
+
+    if numOfFrames == 0:
+        x = numpy.zeros((0, channels), dtype=dtype)
+    else:
+        x = numpy.memmap(path, dtype=dtype, mode='r', offset=dataOffset, shape=(numOfFrames, channels))
+
+    return (Fs, x)
+
+
+def readAudioInfo(path):
+    '''
+    This function returns the sampling rate and the number of samples of an audio file,
+    only the header is read for PCM WAV files.
+    '''
+    header = readWavHeader(path)
+    if header is None:
+        [Fs, x] = readAudioFile(path)
+        if Fs == -1:
+            return (-1, -1)
+        return (Fs, len(x))
+
+    return (header[0], header[4])
+
+
+def readAudioBlocks(path, blockSize, overlap=0):
+    '''
+    This generator reads an audio file in blocks of blockSize samples, each block extended by the first overlap
+    samples of the next one. It yields (start, x), where start is the first sample of the block.
+    PCM WAV files are read block by block, so the memory used does not depend on the file length;
+    the other formats are decoded at once (with pydub) and then split.
+    '''
+    header = readWavHeader(path)
+    if header is None:
+        [Fs, x] = readAudioFile(path)
+        if Fs == -1:
+            return
+        for start in range(0, len(x), blockSize):
+            yield (start, x[start:start + blockSize + overlap])
+        return
+
+    [Fs, channels, dtype, dataOffset, numOfFrames] = header
+    with open(path, 'rb') as f:
+        for start in range(0, numOfFrames, blockSize):
+            f.seek(dataOffset + start * channels * dtype.itemsize)
+            count = min(blockSize + overlap, numOfFrames - start)
+            with Instrumentation.measure('decode') as stage:
+                x = numpy.fromfile(f, dtype=dtype, count=count * channels).reshape(-1, channels)
+                stage.allocated(x.nbytes)
+            if channels == 1:
+                x = x.reshape(-1)
+            yield (start, x)
 
-if sys.version_info >= (3, 0):
-    def xrange(*args, **kwargs):
-        return iter(range(*args, **kwargs))
 
 def readAudioFile(path):
     '''
     This function returns a numpy array that stores the audio samples of a specified WAV file
+    PCM WAV files are read through readWavFile (memory mapped, no copy), the other formats are decoded with pydub.
     '''
+    with Instrumentation.measure('decode') as stage:
+        [Fs, x] = decodeAudioFile(path)
+        if Fs != -1 and not isinstance(x, numpy.memmap):
+            stage.allocated(x.nbytes)
+    return (Fs, x)
+
+
+def decodeAudioFile(path):
     try:
-        audiofile = AudioSegment.from_file(path)
+        [Fs, x] = readWavFile(path)
 
-        if audiofile.sample_width == 2:
-            data = numpy.fromstring(audiofile._data, numpy.int16)
-        elif audiofile.sample_width == 4:
-            data = numpy.fromstring(audiofile._data, numpy.int32)
-        else:
-            return (-1, -1)
-        Fs = audiofile.frame_rate
-        x = []
-        for chn in xrange(audiofile.channels):
-            x.append(data[chn::audiofile.channels])
-        x = numpy.array(x).T
+        if Fs == -1:
+            from pydub import AudioSegment  # pydub (and its ffmpeg lookup) is loaded only for non PCM WAV files
+
+            audiofile = AudioSegment.from_file(path)
+
+            if audiofile.sample_width == 2:
+                data = numpy.frombuffer(audiofile._data, numpy.int16)
+            elif audiofile.sample_width == 4:
+                data = numpy.frombuffer(audiofile._data, numpy.int32)
+            else:
+                return (-1, -1)
+            Fs = audiofile.frame_rate
+            x = data.reshape(-1, audiofile.channels)  # (samples x channels) view of the interleaved data
 
-    except IOError: 
+    except IOError:
         print("Error: file not found or other I/O error.")
         return (-1,-1)
 
     if x.ndim == 2:
         if x.shape[1] == 1:
-            x = x.flatten()
+            x = x.reshape(-1)
 
-    return (Fs, x)
\ No newline at end of file
+    return (Fs, x)
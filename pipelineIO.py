@@ -0,0 +1,97 @@
+import queue
+import sys
+import threading
+
+_END = object()  # end of stream marker
+
+
+def prefetch(iterable, size):
+    '''
+    This generator iterates iterable in a background (reader) thread and yields its items, at most size items
+    are read ahead (bounded queue). The reading (disk or network I/O, decoding) of the next items overlaps with
+    the processing of the current one in the calling thread.
+    An exception raised by iterable is raised again by the generator; when the generator is closed the reader
+    thread stops.
+    '''
+    items = queue.Queue(max(size, 1))
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def reader():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return  # the consumer is gone
+            put((_END, None))
+        except BaseException:
+            put((_END, sys.exc_info()[1]))
+
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is _END:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def writeBehind(iterable, write, size):
+    '''
+    This function calls write(item) for each item of iterable in a background (writer) thread, at most size
+    items wait to be written (bounded queue): the items are produced (e.g. the features computed) in the calling
+    thread while the previous ones are written.
+    The first exception raised by write stops the iteration and is raised again, after the items already
+    written have been flushed.
+    '''
+    items = queue.Queue(max(size, 1))
+    errors = []
+
+    def writer():
+        while True:
+            item = items.get()
+            if item is _END:
+                return
+            if len(errors) == 0:  # after an error the items are discarded, the producer is never blocked
+                try:
+                    write(item)
+                except BaseException:
+                    errors.append(sys.exc_info()[1])
+
+    iterator = iter(iterable)
+    # the writer thread is started after the first item is produced: a process pool used by iterable
+    # is then created (forked) before the thread exists
+    try:
+        item = next(iterator)
+    except StopIteration:
+        return
+
+    thread = threading.Thread(target=writer)
+    thread.daemon = True
+    thread.start()
+    try:
+        items.put(item)
+        for item in iterator:
+            if len(errors) > 0:
+                break
+            items.put(item)
+    finally:
+        items.put(_END)
+        thread.join()
+
+    if len(errors) > 0:
+        raise errors[0]